@@ -0,0 +1,346 @@
+"""Benchmark the hot routes against a seeded database and fail on regressions.
+
+Boots the app in-process against SQLite (or any DATABASE_URL given with --database),
+with local stand-ins for the image host, the SMTP server and Google's OpenID
+discovery document, so no network access is needed. Seeds --users users with
+--photos photos each, then measures latency percentiles and throughput of:
+
+    login          POST /login
+    home           GET  /home
+    upload_photo   POST /upload_photo
+    edit_photo     POST /photo/<id>/edit
+    reset_password POST /reset_password
+
+    python benchmarks/hot_routes.py                   # measure and print
+    python benchmarks/hot_routes.py --save-baseline   # store as benchmarks/baseline.json
+    python benchmarks/hot_routes.py --check           # exit 1 on a regression
+
+Baselines are only comparable on the same machine and with the same options.
+Passwords are hashed at bcrypt cost 4, so /login measures the route and not bcrypt.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+SCENARIOS = ('login', 'home', 'upload_photo', 'edit_photo', 'reset_password')
+
+TAGS = ['beach', 'sunset', 'family', 'mountain', 'city', 'food', 'friends', 'travel', 'snow', 'forest', 'party', 'pets']
+LOCATIONS = ['Goa', 'Mumbai', 'Delhi', 'Manali', 'Jaipur', 'Paris', 'London', '', '']
+PASSWORD = 'benchmark-password'
+
+
+class ImageHostStub(BaseHTTPRequestHandler):
+    "Answers uploads like freeimage.host, and serves an OpenID discovery document."
+
+    def do_POST(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 65536)))
+        self._json({'status_code': 200, 'image': {'url': f"http://{self.headers['Host']}/images/{uuid.uuid4().hex}.jpg"}})
+
+    def do_GET(self):
+        base = f"http://{self.headers['Host']}"
+        self._json({
+            'issuer': base,
+            'authorization_endpoint': f"{base}/auth",
+            'token_endpoint': f"{base}/token",
+            'userinfo_endpoint': f"{base}/userinfo",
+            'jwks_uri': f"{base}/jwks",
+        })
+
+    def _json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SMTPStub(socketserver.StreamRequestHandler):
+    "Accepts and discards every message, speaking just enough SMTP for smtplib."
+
+    def handle(self):
+        self.wfile.write(b'220 benchmark ESMTP\r\n')
+        in_data = False
+        for line in self.rfile:
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    self.wfile.write(b'250 OK\r\n')
+                continue
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.wfile.write(b'250 benchmark\r\n')
+            elif command == b'DATA':
+                in_data = True
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def small_jpeg():
+    from PIL import Image
+    data = io.BytesIO()
+    Image.new('RGB', (64, 48), (200, 120, 40)).save(data, 'JPEG')
+    return data.getvalue()
+
+
+def seed(app, users, photos_per_user):
+    "Insert users with photos spread over the last few years, their tag index and their stats."
+    from flaskalbum import db
+    from flaskalbum.hashing import password_hasher
+    from flaskalbum.models import AlbumStats, Photo, User
+
+    rng = random.Random(42)
+    with app.app_context():
+        password = password_hasher.hash(PASSWORD)
+        accounts = [
+            {'id': uuid.uuid4().hex, 'username': f'user{i}', 'email': f'user{i}@example.com', 'name': f'User {i}', 'password': password}
+            for i in range(users)
+        ]
+        db.session.execute(db.insert(User), accounts)
+
+        start = datetime(2021, 1, 1)
+        for account in accounts:
+            rows = []
+            for i in range(photos_per_user):
+                tags = ', '.join(rng.sample(TAGS, rng.randint(0, 3)))
+                rows.append({
+                    'id': uuid.uuid4().hex,
+                    'filename': f"{account['id']}_{i}.jpg",
+                    'title': f'Photo {i}',
+                    'description': f'{rng.choice(TAGS)} with {rng.choice(TAGS)}',
+                    'location': rng.choice(LOCATIONS),
+                    'tags': tags,
+                    'user_id': account['id'],
+                    'image_url': f'http://images.invalid/{i}.jpg',
+                    'thumbnail_url': f'http://images.invalid/{i}_w320.jpg',
+                    'upload_date': start + timedelta(minutes=rng.randint(0, 3 * 365 * 24 * 60)),
+                    'is_favorite': rng.random() < 0.1,
+                    'status': Photo.STATUS_READY,
+                })
+            db.session.execute(db.insert(Photo), rows)
+            Photo.index_tags({row['id']: row['tags'] for row in rows})
+            db.session.commit()
+
+        AlbumStats.rebuild([account['id'] for account in accounts])
+        db.session.commit()
+    return accounts
+
+
+def run_scenario(app, name, accounts, requests_per_client, concurrency):
+    "Each client thread logs in as its own user and sends requests_per_client requests. Returns the latencies in seconds and the wall time."
+    from flaskalbum.models import Photo
+    image = small_jpeg()
+    with app.app_context():
+        photo_ids = {
+            account['id']: [photo.id for photo in Photo.query.filter_by(user_id=account['id']).with_entities(Photo.id).limit(50)]
+            for account in accounts[:concurrency]
+        }
+
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    ready = threading.Barrier(concurrency + 1)
+
+    def client(account):
+        http = app.test_client()
+        form = {'login': '1', 'username': account['username'], 'password': PASSWORD}
+        if name != 'login' and http.post('/login', data=form).status_code != 302:
+            raise SystemExit(f"{account['username']} could not log in")
+
+        def request(i):
+            if name == 'login':
+                http.get('/logout')
+                return http.post('/login', data=form)
+            if name == 'home':
+                return http.get('/home')
+            if name == 'upload_photo':
+                return http.post('/upload_photo', content_type='multipart/form-data', data={
+                    'photo': (io.BytesIO(image), f'bench{i}.jpg'),
+                    'title': f'Upload {i}', 'description': 'benchmark', 'location': 'Goa', 'tags': 'beach, travel',
+                })
+            if name == 'edit_photo':
+                photo_id = photo_ids[account['id']][i % len(photo_ids[account['id']])]
+                return http.post(f'/photo/{photo_id}/edit', data={
+                    'title': f'Edited {i}', 'description': 'benchmark', 'location': 'Delhi', 'tags': rng_tags(i),
+                })
+            return http.post('/reset_password', data={'email': account['email']})
+
+        times = []
+        errors = []
+        ready.wait()
+        for i in range(requests_per_client):
+            start = time.perf_counter()
+            response = request(i)
+            times.append(time.perf_counter() - start)
+            # Every scenario answers a successful POST with a redirect, and a failed login with 200
+            if response.status_code >= 400 or (name == 'login' and response.status_code != 302):
+                errors.append(response.status_code)
+        with lock:
+            latencies.extend(times)
+            failures.extend(errors)
+
+    threads = [threading.Thread(target=client, args=(account,)) for account in accounts[:concurrency]]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    if failures:
+        raise SystemExit(f"{name}: {len(failures)} requests failed, e.g. HTTP {failures[0]}")
+    return latencies, wall
+
+
+def rng_tags(i):
+    return ', '.join(TAGS[(i + k) % len(TAGS)] for k in range(2))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(latencies, wall):
+    return {
+        'requests': len(latencies),
+        'throughput': round(len(latencies) / wall, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def regressions(results, baseline, tolerance):
+    "Scenarios whose p95 latency or throughput got worse than the baseline by more than tolerance."
+    found = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if not expected:
+            continue
+        if result['p95_ms'] > expected['p95_ms'] * (1 + tolerance):
+            found.append(f"{name}: p95 {result['p95_ms']} ms, baseline {expected['p95_ms']} ms")
+        if result['throughput'] < expected['throughput'] * (1 - tolerance):
+            found.append(f"{name}: {result['throughput']} req/s, baseline {expected['throughput']} req/s")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help='Database URL (default: SQLite in a temporary directory).')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--photos', type=int, default=2000, help='Photos per user.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Client threads, each logged in as a different user.')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per client thread and round.')
+    parser.add_argument('--rounds', type=int, default=3, help='Measured rounds per scenario, the best one is kept to damp noise.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='Only run these scenarios (repeatable).')
+    parser.add_argument('--save-baseline', action='store_true', help=f'Write the results to {os.path.relpath(BASELINE, ROOT)}.')
+    parser.add_argument('--check', action='store_true', help='Exit with status 1 if a scenario regressed against the baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative regression for --check.')
+    args = parser.parse_args()
+    if args.concurrency > args.users:
+        parser.error('--concurrency cannot exceed --users, every client needs its own user')
+
+    directory = tempfile.mkdtemp(prefix='flaskalbum-bench-')
+    image_host = serve(ThreadingHTTPServer(('127.0.0.1', 0), ImageHostStub))
+    smtp = serve(socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPStub))
+
+    database_url = args.database or f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ.update({
+        'DATABASE_URL': database_url,
+        'USER_INFO_TABLE': os.getenv('USER_INFO_TABLE', 'user_info'),
+        'PHOTO_INFO_TABLE': os.getenv('PHOTO_INFO_TABLE', 'photo_info'),
+        'GOOGLE_DISCOVERY_URL': f'http://127.0.0.1:{image_host}/.well-known/openid-configuration',
+    })
+    sys.path.insert(0, ROOT)
+    from flaskalbum import create_app
+    from flaskalbum.commands import init_db
+
+    config = {
+        'UPLOAD_FOLDER': directory,
+        'MEDIA_FOLDER': os.path.join(directory, 'media'),
+        'IMAGE_CACHE_DIR': os.path.join(directory, 'image-cache'),
+        'STORAGE_BACKEND': 'remote',
+        'IMAGE_HOST_URL': f'http://127.0.0.1:{image_host}/upload',
+        'MAIL_SERVER': '127.0.0.1',
+        'MAIL_PORT': smtp,
+        'MAIL_USE_TLS': False,
+        'MAIL_USERNAME': None,
+        'MAIL_SENDER': 'benchmark@example.com',
+        'BCRYPT_LOG_ROUNDS': 4,
+        'BCRYPT_TARGET_MS': 0,
+        'LOGIN_LIMIT_PER_ACCOUNT': 10 ** 6,
+        'LOGIN_LIMIT_PER_IP': 10 ** 6,
+        'UPLOAD_QUEUE_SIZE': 10 ** 5,
+        'SERVER_NAME': 'localhost',
+    }
+    if database_url.startswith('sqlite'):
+        # Wait for SQLite's write lock instead of failing when writers overlap. Passed to
+        # create_app, the engine is created in it and later changes are not seen.
+        config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+    app = create_app(config)
+
+    with app.app_context():
+        app.test_cli_runner().invoke(init_db)
+    started = time.perf_counter()
+    accounts = seed(app, args.users, args.photos)
+    print(f"Seeded {args.users} users x {args.photos} photos in {time.perf_counter() - started:.1f} s")
+
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        # A short unmeasured run first, so templates are compiled and caches warm
+        run_scenario(app, name, accounts, 3, args.concurrency)
+        rounds = [summarize(*run_scenario(app, name, accounts, args.requests, args.concurrency)) for _ in range(args.rounds)]
+        results[name] = max(rounds, key=lambda result: result['throughput'])
+
+    print(f"{'scenario':<16}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, result in results.items():
+        print(f"{name:<16}{result['throughput']:>9}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}")
+
+    if args.save_baseline:
+        with open(BASELINE, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline written to {os.path.relpath(BASELINE, ROOT)}")
+
+    if args.check:
+        if not os.path.exists(BASELINE):
+            raise SystemExit(f"No baseline at {os.path.relpath(BASELINE, ROOT)}, run with --save-baseline first")
+        with open(BASELINE, encoding='utf-8') as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        if found:
+            print('Regressions:\n  ' + '\n  '.join(found))
+            raise SystemExit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
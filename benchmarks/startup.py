@@ -0,0 +1,66 @@
+"""Measure how long a fresh worker process takes to import flaskalbum, build the app
+and answer its first request.
+
+Each run is a new interpreter, so nothing is cached between runs. The app runs against
+a throwaway SQLite database (DATABASE_URL), created once with `flask init-db`.
+
+    python benchmarks/startup.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside each measured process and prints its timings as JSON
+PROBE = '''
+import json, time
+start = time.perf_counter()
+import flaskalbum
+imported = time.perf_counter()
+app = flaskalbum.create_app()
+created = time.perf_counter()
+response = app.test_client().get('/login')
+assert response.status_code == 200, response.status_code
+answered = time.perf_counter()
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first_request': answered - created,
+    'total': answered - start,
+}))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='Fresh processes to measure.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(
+            os.environ,
+            DATABASE_URL=f"sqlite:///{os.path.join(directory, 'startup.db')}",
+            USER_INFO_TABLE=os.getenv('USER_INFO_TABLE', 'user_info'),
+            PHOTO_INFO_TABLE=os.getenv('PHOTO_INFO_TABLE', 'photo_info'),
+            PYTHONDONTWRITEBYTECODE='1',
+        )
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'flaskalbum', 'init-db'], cwd=ROOT, env=env, check=True, capture_output=True)
+
+        samples = []
+        for _ in range(args.runs):
+            output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env, check=True, capture_output=True, text=True).stdout
+            samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'phase':<14}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for phase in ('import', 'create_app', 'first_request', 'total'):
+        values = [sample[phase] * 1000 for sample in samples]
+        print(f"{phase:<14}{statistics.median(values):>12.1f}{min(values):>10.1f}{max(values):>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Measure the throughput of a running server: concurrent clients request the given
+paths in a loop for a fixed time, then requests per second and latency percentiles
+are printed.
+
+    python benchmarks/throughput.py http://127.0.0.1:8000 /login /home --login alice:secret
+
+With --login every client first logs in with the username and password, so pages
+behind @login_required can be measured.
+"""
+import argparse
+import statistics
+import threading
+import time
+import requests
+
+
+def client(base_url, paths, credentials, deadline, latencies, errors):
+    session = requests.Session()
+    if credentials:
+        username, password = credentials.split(':', 1)
+        session.post(f"{base_url}/login", data={'login': '1', 'username': username, 'password': password}, allow_redirects=False)
+
+    i = 0
+    while time.perf_counter() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            response = session.get(base_url + path, allow_redirects=False, timeout=30)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        (latencies if ok else errors).append(elapsed)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base_url')
+    parser.add_argument('paths', nargs='+')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20, help='Seconds to measure.')
+    parser.add_argument('--login', help='username:password to log every client in with.')
+    args = parser.parse_args()
+
+    latencies, errors = [], []
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=client, args=(args.base_url.rstrip('/'), args.paths, args.login, deadline, latencies, errors))
+        for _ in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if not latencies:
+        raise SystemExit(f"No successful requests ({len(errors)} errors)")
+    print(f"requests/s  {len(latencies) / args.duration:.1f}")
+    print(f"errors      {len(errors)}")
+    print(f"p50 ms      {statistics.median(latencies) * 1000:.1f}")
+    print(f"p95 ms      {percentile(latencies, 0.95) * 1000:.1f}")
+    print(f"p99 ms      {percentile(latencies, 0.99) * 1000:.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,99 +4,213 @@ from dotenv import load_dotenv
 # Load environment variables
 load_dotenv()
 from flask_sqlalchemy import SQLAlchemy
-import mysql.connector
 from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
-from flask_admin import Admin
-from flask_admin.contrib.sqla import ModelView
 import os
-from oauthlib.oauth2 import WebApplicationClient
 
-# Create Flask app
-app = Flask(__name__)
-app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'
+# Extensions are created unbound and attached to the app in create_app
+db = SQLAlchemy()
+bcrypt = Bcrypt()
+login_manager = LoginManager()
 
+# Configure login manager
+login_manager.login_view = 'main.login'
+login_manager.login_message_category = 'info'
 
 
-# Load environment variables
-MYSQL_HOST = os.getenv('MYSQL_HOST')
-MYSQL_USER = os.getenv('MYSQL_USER')
-MYSQL_ROOT_PASSWORD = os.getenv('MYSQL_ROOT_PASSWORD')
-PHOTO_ALBUM_DB = os.getenv('PHOTO_ALBUM_DB')
-GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
-
-app.config['MYSQL_HOST'] = MYSQL_HOST
-app.config['MYSQL_USER'] = MYSQL_USER
-app.config['MYSQL_PASSWORD'] = MYSQL_ROOT_PASSWORD
-
-# Configure upload folder
-current_directory = os.path.dirname(os.path.abspath(__file__))
-
-# Define the upload folder path relative to the current directory
-UPLOAD_FOLDER = os.path.join(current_directory, '..', 'uploads')
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
-# Configure SQLAlchemy with MySQL Connector
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    f"mysql+mysqlconnector://{MYSQL_USER}:"
-    f"{MYSQL_ROOT_PASSWORD}@"
-    f"{MYSQL_HOST}/"
-    f"{PHOTO_ALBUM_DB}"
-)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_pre_ping': True,  # Connection health check
-    'pool_recycle': 3600,   # Recycle connections after 1 hour
-}
-
-# Initialize extensions
-db = SQLAlchemy(app)
-bcrypt = Bcrypt(app)
-login_manager = LoginManager(app)
-admin = Admin(app, name='Admin Panel', template_mode='bootstrap3')
-
-# OAuth 2.0 client
-client = WebApplicationClient(GOOGLE_CLIENT_ID)
+# Create Flask app. Importing the package does no I/O; the database schema is
+# created by `flask init-db`, and admin views and the OAuth client are built on first use.
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = '5791628bb0b13ce0c676dfde280ba245'
+
+    # Load environment variables
+    MYSQL_HOST = os.getenv('MYSQL_HOST')
+    MYSQL_USER = os.getenv('MYSQL_USER')
+    MYSQL_ROOT_PASSWORD = os.getenv('MYSQL_ROOT_PASSWORD')
+    PHOTO_ALBUM_DB = os.getenv('PHOTO_ALBUM_DB')
+
+    app.config['MYSQL_HOST'] = MYSQL_HOST
+    app.config['MYSQL_USER'] = MYSQL_USER
+    app.config['MYSQL_PASSWORD'] = MYSQL_ROOT_PASSWORD
+
+    # Google sign-in
+    app.config['GOOGLE_DISCOVERY_URL'] = os.getenv('GOOGLE_DISCOVERY_URL')
+    app.config['GOOGLE_CLIENT_ID'] = os.getenv('GOOGLE_CLIENT_ID')
+
+    # Configure upload folder
+    current_directory = os.path.dirname(os.path.abspath(__file__))
+
+    # Define the upload folder path relative to the current directory
+    UPLOAD_FOLDER = os.path.join(current_directory, '..', 'uploads')
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+
+    # Storage backend for photo files: 'remote' pushes them to the image host below,
+    # 'local' keeps them in MEDIA_FOLDER and serves them from /media
+    app.config['STORAGE_BACKEND'] = os.getenv('STORAGE_BACKEND', 'remote')
+    app.config['MEDIA_FOLDER'] = os.getenv('MEDIA_FOLDER', os.path.join(UPLOAD_FOLDER, 'media'))
+    app.config['MEDIA_MAX_AGE'] = int(os.getenv('MEDIA_MAX_AGE', 365 * 24 * 3600))
+
+    # Upload size limits. Werkzeug rejects larger request bodies with 413 before reading them,
+    # and spools accepted files to disk instead of keeping them in memory.
+    app.config['MAX_PHOTO_SIZE'] = int(os.getenv('MAX_PHOTO_MB', 20)) * 1024 * 1024
+    app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_REQUEST_MB', 200)) * 1024 * 1024
+
+    # Image host (freeimage.host by default, point IMAGE_HOST_URL at a local stand-in for testing)
+    app.config['IMAGE_HOST_URL'] = os.getenv('IMAGE_HOST_URL', 'https://freeimage.host/api/1/upload')
+    app.config['IMG_API_KEY'] = os.getenv('IMG_API_KEY')
+    app.config['IMAGE_HOST_TIMEOUT'] = float(os.getenv('IMAGE_HOST_TIMEOUT', 30))
+    app.config['IMAGE_HOST_RETRIES'] = int(os.getenv('IMAGE_HOST_RETRIES', 3))
+    app.config['IMAGE_HOST_BACKOFF'] = float(os.getenv('IMAGE_HOST_BACKOFF', 1))
+
+    # Background upload workers
+    app.config['UPLOAD_WORKERS'] = int(os.getenv('UPLOAD_WORKERS', 4))
+    app.config['UPLOAD_QUEUE_SIZE'] = int(os.getenv('UPLOAD_QUEUE_SIZE', 100))
+    # Photos pending for longer are taken to have lost their upload job and shown as failed
+    app.config['UPLOAD_PENDING_MAX_AGE'] = int(os.getenv('UPLOAD_PENDING_MAX_AGE', 1800))
+    # Background removal of the files of deleted photos, one job per deleted batch
+    app.config['CLEANUP_QUEUE_SIZE'] = int(os.getenv('CLEANUP_QUEUE_SIZE', 1000))
+
+    # Search: 'fulltext' (MySQL FULLTEXT index), 'memory' (in-process inverted index) or 'auto'
+    app.config['SEARCH_BACKEND'] = os.getenv('SEARCH_BACKEND', 'auto')
+
+    # Worker processes resizing uploads into thumbnails, per server process (gunicorn.conf.py
+    # divides the CPUs between its workers)
+    app.config['DERIVATIVE_PROCESSES'] = int(os.getenv('DERIVATIVE_PROCESSES', max(1, (os.cpu_count() or 2) // 2)))
+
+    # Batch uploads: concurrent transfers per request and maximum files per request
+    app.config['UPLOAD_BATCH_FANOUT'] = int(os.getenv('UPLOAD_BATCH_FANOUT', 8))
+    app.config['UPLOAD_BATCH_MAX_FILES'] = int(os.getenv('UPLOAD_BATCH_MAX_FILES', 100))
+
+    # Most photos one /api/photos/bulk request may change
+    app.config['BULK_MAX_PHOTOS'] = int(os.getenv('BULK_MAX_PHOTOS', 500))
+
+    # Images an album export downloads at the same time
+    app.config['EXPORT_FETCH_WORKERS'] = int(os.getenv('EXPORT_FETCH_WORKERS', 4))
+
+    # Remote images (image host photos, Google profile pictures) are served through /img,
+    # which keeps a copy of each in IMAGE_CACHE_DIR, up to IMAGE_CACHE_MAX_MB
+    app.config['IMAGE_PROXY'] = os.getenv('IMAGE_PROXY', 'true').lower() == 'true'
+    app.config['IMAGE_CACHE_DIR'] = os.getenv('IMAGE_CACHE_DIR', os.path.join(UPLOAD_FOLDER, 'image-cache'))
+    app.config['IMAGE_CACHE_MAX_MB'] = int(os.getenv('IMAGE_CACHE_MAX_MB', 500))
+    app.config['IMAGE_PROXY_TIMEOUT'] = float(os.getenv('IMAGE_PROXY_TIMEOUT', 10))
+    app.config['IMAGE_PROXY_MAX_AGE'] = int(os.getenv('IMAGE_PROXY_MAX_AGE', 30 * 24 * 3600))
+
+    # Rendered photo cards kept in memory, keyed by photo and album version
+    app.config['FRAGMENT_CACHE_SIZE'] = int(os.getenv('FRAGMENT_CACHE_SIZE', 5000))
+    app.config['FRAGMENT_CACHE_TTL'] = int(os.getenv('FRAGMENT_CACHE_TTL', 3600))
+
+    # Configure SQLAlchemy with MySQL Connector, or any database given as DATABASE_URL
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL') or (
+        f"mysql+mysqlconnector://{MYSQL_USER}:"
+        f"{MYSQL_ROOT_PASSWORD}@"
+        f"{MYSQL_HOST}/"
+        f"{PHOTO_ALBUM_DB}"
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_pre_ping': True,  # Connection health check
+        'pool_recycle': 3600,   # Recycle connections after 1 hour
+    }
+    # Connections per worker process. gunicorn.conf.py sets these from the worker and
+    # thread counts so that all workers together stay under the database's connection limit.
+    if os.getenv('DB_POOL_SIZE'):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size'] = int(os.getenv('DB_POOL_SIZE'))
+        app.config['SQLALCHEMY_ENGINE_OPTIONS']['max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW', 0))
+
+    # Password hashing: bcrypt cost (or a target time per hash to calibrate it at startup)
+    # and the bounded pool the hashes run on
+    app.config['BCRYPT_LOG_ROUNDS'] = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+    app.config['BCRYPT_TARGET_MS'] = float(os.getenv('BCRYPT_TARGET_MS', 0))
+    app.config['BCRYPT_MIN_ROUNDS'] = int(os.getenv('BCRYPT_MIN_ROUNDS', 10))
+    app.config['BCRYPT_WORKERS'] = int(os.getenv('BCRYPT_WORKERS', os.cpu_count() or 1))
+    app.config['BCRYPT_MAX_PENDING'] = int(os.getenv('BCRYPT_MAX_PENDING', 32))
+    app.config['BCRYPT_WAIT_TIMEOUT'] = float(os.getenv('BCRYPT_WAIT_TIMEOUT', 2))
+
+    # Cache of logged-in users, so most requests skip the user lookup. Set CACHE_URL
+    # (redis://... or memory:// for the in-process stand-in) to share it between workers.
+    app.config['USER_CACHE_SIZE'] = int(os.getenv('USER_CACHE_SIZE', 10000))
+    app.config['USER_CACHE_TTL'] = int(os.getenv('USER_CACHE_TTL', 30))
+    app.config['CACHE_URL'] = os.getenv('CACHE_URL')
+
+    # Login throttling: attempts allowed per account and per client IP within the window (seconds)
+    app.config['LOGIN_LIMIT_PER_ACCOUNT'] = int(os.getenv('LOGIN_LIMIT_PER_ACCOUNT', 10))
+    app.config['LOGIN_LIMIT_PER_IP'] = int(os.getenv('LOGIN_LIMIT_PER_IP', 50))
+    app.config['LOGIN_LIMIT_WINDOW'] = int(os.getenv('LOGIN_LIMIT_WINDOW', 900))
+
+    # Number of reverse proxies (nginx, a load balancer) in front of the app. The client IP,
+    # scheme and host are then taken from the X-Forwarded-* headers they set; with 0 the
+    # proxy's own address would be every client's, and all clients would share one login limit.
+    app.config['TRUSTED_PROXIES'] = int(os.getenv('TRUSTED_PROXIES', 0))
+
+    # Outgoing mail, sent from a background thread over one reused SMTP connection.
+    # Point MAIL_SERVER at a local debugging server (e.g. aiosmtpd) in development.
+    app.config['MAIL_SERVER'] = os.getenv('MAIL_SERVER', 'smtp.zoho.in')
+    app.config['MAIL_PORT'] = int(os.getenv('MAIL_PORT', 587))
+    app.config['MAIL_USE_TLS'] = os.getenv('MAIL_USE_TLS', 'true').lower() == 'true'
+    app.config['MAIL_USERNAME'] = os.getenv('EMAIL_ID')
+    app.config['MAIL_PASSWORD'] = os.getenv('EMAIL_PASS')
+    app.config['MAIL_SENDER'] = os.getenv('MAIL_SENDER', app.config['MAIL_USERNAME'])
+    app.config['MAIL_TIMEOUT'] = float(os.getenv('MAIL_TIMEOUT', 30))
+    app.config['MAIL_BATCH_SIZE'] = int(os.getenv('MAIL_BATCH_SIZE', 20))
+    app.config['MAIL_RETRIES'] = int(os.getenv('MAIL_RETRIES', 3))
+    app.config['MAIL_BACKOFF'] = float(os.getenv('MAIL_BACKOFF', 1))
+    app.config['MAIL_IDLE_TIMEOUT'] = float(os.getenv('MAIL_IDLE_TIMEOUT', 60))
+    app.config['MAIL_QUEUE_SIZE'] = int(os.getenv('MAIL_QUEUE_SIZE', 1000))
+
+    # Instrumentation: /metrics in the Prometheus text format (behind a bearer token when
+    # METRICS_TOKEN is set), and a log of requests slower than SLOW_REQUEST_MS with their SQL (0 = off)
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN')
+    app.config['SLOW_REQUEST_MS'] = float(os.getenv('SLOW_REQUEST_MS', 0))
+
+    # Overrides, e.g. from tests or benchmarks
+    app.config.update(config or {})
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # Initialize extensions
+    db.init_app(app)
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+
+    from flaskalbum.metrics import metrics
+    metrics.init_app(app)
+    from flaskalbum.hashing import password_hasher
+    password_hasher.init_app(app)
+    from flaskalbum.mail import outbox
+    outbox.init_app(app)
+    from flaskalbum.models import user_cache
+    from flaskalbum.cache import shared_backend
+    user_cache.configure(
+        maxsize=app.config['USER_CACHE_SIZE'],
+        ttl=app.config['USER_CACHE_TTL'],
+        shared=shared_backend(app.config['CACHE_URL'])
+    )
 
-# Configure login manager
-login_manager.login_view = 'login'
-login_manager.login_message_category = 'info'
+    # Import routes and CLI commands
+    from flaskalbum import routes, commands
+    app.register_blueprint(routes.main)
+    app.register_blueprint(commands.cli)
+
+    # Admin interface, built on the first request to /admin
+    from werkzeug.middleware.dispatcher import DispatcherMiddleware
+    from flaskalbum.admin import LazyAdmin
+    app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {'/admin': LazyAdmin(app)})
+
+    if app.config['TRUSTED_PROXIES']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        proxies = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+
+    return app
 
-# Import models
-from flaskalbum.models import Photo, User
 
 # User loader callback
 @login_manager.user_loader
 def load_user(id):
     if id is None:
         return None
+    from flaskalbum.models import User
     try:
-        return User.query.get(id)
+        return User.load(id)
     except (ValueError, TypeError):
         return None
-
-# Create database if not exists
-def create_database():
-    mydb = mysql.connector.connect(
-        host=f"{MYSQL_HOST}",
-        user=f"{MYSQL_USER}",
-        password=f"{MYSQL_ROOT_PASSWORD}"
-    )
-    mycursor = mydb.cursor()
-    mycursor.execute(f"CREATE DATABASE IF NOT EXISTS {PHOTO_ALBUM_DB}")
-    mycursor.execute(f"USE {PHOTO_ALBUM_DB}")
-    mycursor.close()
-
-# Initialize database
-with app.app_context():
-    create_database()
-    db.create_all()
-
-# Add model views to admin interface
-admin.add_view(ModelView(User, db.session))
-admin.add_view(ModelView(Photo, db.session))
-
-# Import routes
-from flaskalbum import routes
\ No newline at end of file
@@ -0,0 +1,152 @@
+import threading
+from flask import Flask, flash
+from sqlalchemy import orm
+from flaskalbum import db
+from flaskalbum.cache import TTLCache
+
+# Rows per admin list page, and how long the last id of a listed page is remembered
+ADMIN_PAGE_SIZE = 50
+PAGE_CURSOR_TTL = 600
+
+
+def approximate_count(session, model):
+    "Row count of a model's table from the database's statistics (MySQL's information_schema, PostgreSQL's pg_class) instead of a COUNT(*) over the whole table. Other databases are counted exactly."
+    table = model.__table__.name
+    dialect = session.get_bind().dialect.name
+    count = None
+    if dialect == 'mysql':
+        count = session.execute(
+            db.text("SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table"),
+            {'table': table},
+        ).scalar()
+    elif dialect == 'postgresql':
+        count = session.execute(db.text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)"), {'table': table}).scalar()
+    if count is None or count < 0:
+        count = session.query(db.func.count()).select_from(model.__table__).scalar()
+    return count
+
+
+def create_admin_app(app):
+    "Build the Flask-Admin app mounted under /admin, with the same config as the main app. Its views query through the main app's engine, so admin requests draw on the same connection pool instead of a second one."
+    admin_app = Flask(__name__, static_folder=None)
+    admin_app.config.update(app.config)
+    with app.app_context():
+        # One session per admin request (and thread), on the main app's engine
+        session = orm.scoped_session(orm.sessionmaker(bind=db.engine))
+
+    @admin_app.teardown_appcontext
+    def remove_session(exception):
+        session.remove()
+
+    # Imported here, Flask-Admin and its SQLAlchemy integration are slow to import
+    from flask_admin import Admin
+    from flask_admin.actions import action
+    from flask_admin.contrib.sqla import ModelView
+    from flaskalbum.models import Photo, User
+
+    class LargeTableView(ModelView):
+        "List views that stay fast on tables with millions of rows. The row count comes from the table statistics, and no count is run at all while searching or filtering. Pages are ordered by primary key; paging forward from a listed page seeks past its last id instead of skipping rows with OFFSET. Search matches column prefixes (term%), which an index can answer, and bulk deletes are single set-based statements."
+        simple_list_pager = True
+        can_set_page_size = False
+        page_size = ADMIN_PAGE_SIZE
+        column_default_sort = ('id', False)
+
+        def __init__(self, model, session, **kwargs):
+            super().__init__(model, session, **kwargs)
+            # (search, filters, page) -> last id of the page before it
+            self._cursors = TTLCache(1000, ttl=PAGE_CURSOR_TTL)
+
+        def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+            page = page or 0
+            page_size = page_size or self.page_size
+            # page_size=0 makes Flask-Admin leave out LIMIT and OFFSET, they are added below
+            _, query = super().get_list(None, sort_column, sort_desc, search, filters, execute=False, page_size=0)
+            count = approximate_count(self.session, self.model) if not search and not filters else None
+
+            # Only the default order (by primary key, ascending) can seek
+            key = (search, tuple(map(tuple, filters or ())), page) if sort_column is None else None
+            cursor = self._cursors.get(key) if key and page else None
+            if cursor is not None:
+                query = query.filter(self.model.id > cursor).limit(page_size)
+            else:
+                query = query.limit(page_size).offset(page * page_size)
+            if not execute:
+                return count, query
+
+            rows = query.all()
+            if key and len(rows) == page_size:
+                self._cursors.set(key[:2] + (page + 1,), rows[-1].id)
+            return count, rows
+
+        def _apply_search(self, query, count_query, joins, count_joins, search):
+            for term in search.split():
+                query = query.filter(db.or_(*(column.startswith(term, autoescape=True) for column, _ in self._search_fields)))
+            return query, count_query, joins, count_joins
+
+        def delete_model(self, model):
+            return self.delete_ids([model.id]) > 0
+
+        @action('delete', 'Delete', 'Are you sure you want to delete the selected records?')
+        def action_delete(self, ids):
+            count = self.delete_ids(ids)
+            if count:
+                flash(f'{count} records deleted.', 'success')
+
+        def delete_ids(self, ids):
+            "Delete the rows with these ids, return how many were deleted."
+            raise NotImplementedError
+
+    class UserView(LargeTableView):
+        column_list = ('id', 'username', 'name', 'email')
+        column_searchable_list = ('username', 'email')
+        column_sortable_list = ('id', 'username', 'email')
+        # Relationship fields would load every photo into the form
+        form_excluded_columns = ('photos', 'album_stats')
+
+        def delete_ids(self, ids):
+            # In the main app, whose search backend and cleanup workers the deletion updates
+            with app.app_context():
+                try:
+                    return User.delete_accounts(ids)
+                except Exception as e:
+                    db.session.rollback()
+                    flash(f'Failed to delete users: {e}', 'error')
+                    return 0
+
+    class PhotoView(LargeTableView):
+        column_list = ('id', 'user_id', 'title', 'upload_date', 'status', 'is_favorite')
+        column_searchable_list = ('id', 'user_id')
+        column_sortable_list = ('id',)
+        # The owner field (the backref named after the users table) would list every user
+        form_excluded_columns = (User.__tablename__, 'tag_index')
+
+        def delete_ids(self, ids):
+            with app.app_context():
+                try:
+                    deleted = Photo.delete_many(ids)
+                except Exception as e:
+                    db.session.rollback()
+                    flash(f'Failed to delete photos: {e}', 'error')
+                    return 0
+            return sum(len(photo_ids) for photo_ids in deleted.values())
+
+    admin = Admin(admin_app, name='Admin Panel', url='/', template_mode='bootstrap3')
+    admin.add_view(UserView(User, session))
+    admin.add_view(PhotoView(Photo, session))
+    return admin_app
+
+
+class LazyAdmin:
+    "WSGI app for /admin that builds the admin app and its model views on the first request, instead of in every worker at startup."
+
+    def __init__(self, app):
+        self.app = app
+        self._admin_app = None
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if self._admin_app is None:
+            with self._lock:
+                if self._admin_app is None:
+                    self._admin_app = create_admin_app(self.app)
+        return self._admin_app(environ, start_response)
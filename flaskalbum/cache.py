@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    "Thread-safe in-process LRU cache. Holds at most maxsize entries, and entries also expire ttl seconds after they were set."
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DictBackend:
+    "In-process stand-in for a shared key/value store, with the get/set(ex=)/delete interface of a redis client."
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                return None
+            return entry[0]
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else float('inf'))
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class ObjectCache:
+    "Cache of JSON-serializable values. Without a shared backend it is an in-process TTLCache, which other worker processes cannot invalidate, so keep its ttl short. With a shared backend (a redis client or anything with the same get/set/delete methods) every process reads and invalidates the same entries."
+
+    def __init__(self, prefix, maxsize=1024, ttl=60, shared=None):
+        self.prefix = prefix
+        self.configure(maxsize, ttl, shared)
+
+    def configure(self, maxsize=1024, ttl=60, shared=None):
+        "Resize the cache and pick its backend, dropping anything cached so far."
+        self.ttl = ttl
+        self.local = TTLCache(maxsize, ttl)
+        self.shared = shared
+
+    def get(self, key):
+        if self.shared is None:
+            return self.local.get(key)
+        raw = self.shared.get(f"{self.prefix}:{key}")
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value):
+        if self.shared is None:
+            self.local.set(key, value)
+        else:
+            self.shared.set(f"{self.prefix}:{key}", json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        if self.shared is None:
+            self.local.delete(key)
+        else:
+            self.shared.delete(f"{self.prefix}:{key}")
+
+
+def shared_backend(url):
+    "Connect to the shared cache at url: 'memory://' for the in-process stand-in, or a redis:// URL (needs the redis package)."
+    if not url:
+        return None
+    if url.startswith('memory://'):
+        return DictBackend()
+    import redis
+    return redis.Redis.from_url(url)
@@ -0,0 +1,195 @@
+import csv
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import click
+import requests
+from flask import Blueprint, current_app
+from sqlalchemy import create_engine, text
+from flaskalbum import db
+from flaskalbum.derivatives import store_derivatives
+from flaskalbum.export import copy_stream, export_ndjson, export_zip
+from flaskalbum.metrics import metrics
+from flaskalbum.models import AlbumStats, Photo, User, photo_tags
+from flaskalbum.schema import add_missing_columns, create_missing_indexes
+from flaskalbum.storage import LocalStorage, get_storage
+from flaskalbum.uploads import get_upload_queue, requeue_pending
+
+# Registered by create_app; the commands are top-level (flask init-db, ...)
+cli = Blueprint('commands', __name__, cli_group=None)
+
+
+def fetch_original(photo, directory):
+    "Return a local path holding the original image of a photo, downloading it if it is not stored locally."
+    storage = get_storage()
+    if photo.storage_key and isinstance(storage, LocalStorage):
+        path = storage.path(photo.storage_key)
+        if os.path.exists(path):
+            return path
+
+    path = os.path.join(directory, photo.id)
+    with metrics.track_http(photo.image_url), requests.get(photo.image_url, stream=True, timeout=current_app.config['IMAGE_HOST_TIMEOUT']) as response:
+        response.raise_for_status()
+        with open(path, 'wb') as out:
+            for chunk in response.iter_content(1024 * 1024):
+                out.write(chunk)
+    return path
+
+
+def create_database():
+    "Create the MySQL database named in the database URL if it does not exist yet."
+    url = db.engine.url
+    if url.get_backend_name() != 'mysql':
+        return
+    server = create_engine(url.set(database=None))
+    try:
+        with server.connect() as connection:
+            connection.execute(text(f"CREATE DATABASE IF NOT EXISTS `{url.database}`"))
+    finally:
+        server.dispose()
+
+
+@cli.cli.command('init-db')
+def init_db():
+    "Create the database, its tables, and any columns or indexes added since it was created."
+    create_database()
+    db.create_all()
+    add_missing_columns()
+    create_missing_indexes()
+    click.echo("Database is up to date")
+
+
+@cli.cli.command('backfill-derivatives')
+@click.option('--batch-size', default=200, show_default=True, help='Photos loaded and committed at a time.')
+@click.option('--workers', default=8, show_default=True, help='Photos downloaded and resized concurrently.')
+def backfill_derivatives(batch_size, workers):
+    "Create thumbnails for photos uploaded before thumbnails were generated."
+    missing = Photo.query.filter(
+        Photo.thumbnail_url.is_(None),
+        Photo.image_url.isnot(None),
+        Photo.status == Photo.STATUS_READY,
+    ).with_entities(Photo.id, Photo.user_id, Photo.image_url, Photo.storage_key)
+
+    app = current_app._get_current_object()
+
+    def backfill(photo):
+        with app.app_context():
+            directory = tempfile.mkdtemp(prefix='backfill-', dir=app.config['UPLOAD_FOLDER'])
+            try:
+                thumbnail_url, srcset = store_derivatives(photo.id, fetch_original(photo, directory))
+                return {'id': photo.id, 'thumbnail_url': thumbnail_url, 'srcset': srcset}
+            except Exception as e:
+                app.logger.warning(f"Could not create thumbnails of photo {photo.id}: {e}")
+                return None
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    done = failed = 0
+    last_id = ''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            # Keyset over the primary key, photos that fail are not picked up again
+            batch = missing.filter(Photo.id > last_id).order_by(Photo.id).limit(batch_size).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            updates = [update for update in pool.map(backfill, batch) if update]
+            if updates:
+                # Cached galleries of these users must show the thumbnails
+                updated = {update['id'] for update in updates}
+                user_ids = sorted({photo.user_id for photo in batch if photo.id in updated})
+                for user_id in user_ids:
+                    AlbumStats.lock(user_id)
+                db.session.execute(db.update(Photo), updates)
+                for user_id in user_ids:
+                    AlbumStats.bump(user_id)
+                db.session.commit()
+            done += len(updates)
+            failed += len(batch) - len(updates)
+            click.echo(f"{done} photos updated, {failed} failed")
+
+
+@cli.cli.command('backfill-tags')
+@click.option('--batch-size', default=500, show_default=True, help='Photos indexed and committed at a time.')
+def backfill_tags(batch_size):
+    "Fill the tag index from the comma separated tags of existing photos. Safe to run again."
+    done = 0
+    last_id = ''
+    while True:
+        batch = (
+            db.session.query(Photo.id, Photo.tags)
+            .filter(Photo.id > last_id, Photo.tags.isnot(None), Photo.tags != '')
+            .order_by(Photo.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        # Rebuild the batch's index rows from scratch so re-runs do not duplicate them
+        db.session.execute(photo_tags.delete().where(photo_tags.c.photo_id.in_([photo.id for photo in batch])))
+        Photo.index_tags({photo.id: photo.tags for photo in batch})
+        db.session.commit()
+        done += len(batch)
+        click.echo(f"{done} photos indexed")
+
+
+@cli.cli.command('provision-users')
+@click.argument('csv_file', type=click.File('r', encoding='utf-8'))
+@click.option('--batch-size', default=500, show_default=True, help='Users inserted and committed at a time.')
+@click.option('--workers', default=8, show_default=True, help='Passwords hashed in parallel.')
+def provision_users(csv_file, batch_size, workers):
+    "Create accounts in bulk from a CSV file with name, email, username and password columns."
+    users = csv.DictReader(csv_file)
+    missing = {'name', 'email', 'username', 'password'} - set(users.fieldnames or ())
+    if missing:
+        raise click.UsageError(f"CSV file is missing the columns: {', '.join(sorted(missing))}")
+
+    created, skipped = User.bulk_register(users, batch_size=batch_size, workers=workers)
+    click.echo(f"{created} users created, {skipped} skipped because the username or email already exists")
+
+
+@cli.cli.command('reconcile-stats')
+@click.option('--batch-size', default=100, show_default=True, help='Users rebuilt and committed at a time.')
+def reconcile_stats(batch_size):
+    "Rebuild every user's album stats from their photos, fixing any drift."
+    done = 0
+    last_id = ''
+    while True:
+        user_ids = [
+            user.id for user in
+            db.session.query(User.id).filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+        ]
+        if not user_ids:
+            break
+        AlbumStats.rebuild(user_ids)
+        db.session.commit()
+        last_id = user_ids[-1]
+        done += len(user_ids)
+        click.echo(f"{done} users reconciled")
+
+
+@cli.cli.command('export-album')
+@click.argument('username')
+@click.option('--format', 'export_format', type=click.Choice(['ndjson', 'zip']), default='zip', show_default=True, help='Photo metadata only, or a ZIP of the photos and their metadata.')
+@click.option('--output', type=click.File('wb'), default='-', help='File written to, standard output by default.')
+def export_album(username, export_format, output):
+    "Export a user's album, written as it is produced."
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.UsageError(f"No user named {username}")
+    export = export_zip if export_format == 'zip' else export_ndjson
+    copy_stream(export(user.id), output)
+
+
+@cli.cli.command('recover-uploads')
+@click.option('--min-age', default=10, show_default=True, help='Minutes a photo must have been pending. Keep it longer than an upload job can take (IMAGE_HOST_TIMEOUT times IMAGE_HOST_RETRIES, plus time in the queue) so uploads still held by running servers are left alone; 0 only when no server is running.')
+def recover_uploads(min_age):
+    "Upload the photos left pending by server workers that stopped before their upload jobs ran, and mark those whose staged file is gone failed."
+    queued, failed = requeue_pending(timedelta(minutes=min_age))
+    get_upload_queue().join()
+    click.echo(f"{queued} pending uploads processed, {failed} marked failed")
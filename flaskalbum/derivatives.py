@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+from PIL import Image, ImageOps
+from flaskalbum.storage import get_storage
+
+# Widths (in pixels) of the resized copies made of every photo
+DERIVATIVE_WIDTHS = (320, 640, 1280)
+JPEG_QUALITY = 82
+
+# Resizing is CPU bound, so it runs in worker processes rather than threads.
+# Created on first use so importing this module never forks.
+process_pool = None
+# The pool is started from a process already running threads (gunicorn's, the job queues')
+# and holding database and HTTP connections. Forked children would inherit those, and
+# locks held by other threads at fork time. A fork server starts them from a clean process.
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+process_pool_lock = threading.Lock()
+
+
+def get_process_pool():
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(
+                max_workers=current_app.config['DERIVATIVE_PROCESSES'],
+                mp_context=multiprocessing.get_context(START_METHOD),
+            )
+        return process_pool
+
+
+def derivative_key(photo_id, width):
+    "Storage key of the copy of a photo resized to the given width."
+    return f"{photo_id}_w{width}.jpg"
+
+
+def render_derivatives(source_path, output_dir, widths=DERIVATIVE_WIDTHS):
+    "Resize the image at source_path to each width and save them as JPEGs in output_dir. Images are never upscaled; a photo narrower than every width gets one copy at its own width. Runs in a worker process. Returns {width: path}."
+    with Image.open(source_path) as image:
+        # Apply the EXIF orientation before resizing, JPEG copies drop the EXIF data
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        targets = [width for width in widths if width < image.width] or [image.width]
+        outputs = {}
+        for width in targets:
+            height = max(1, round(image.height * width / image.width))
+            resized = image.resize((width, height), Image.LANCZOS)
+            path = os.path.join(output_dir, f"w{width}.jpg")
+            resized.save(path, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            outputs[width] = path
+        return outputs
+
+
+def store_derivatives(photo_id, source_path):
+    "Render the resized copies of a photo in the process pool and save them to the storage backend. Returns the (thumbnail_url, srcset) to store on the photo."
+    storage = get_storage()
+    output_dir = tempfile.mkdtemp(prefix='derivatives-', dir=current_app.config['UPLOAD_FOLDER'])
+    try:
+        outputs = get_process_pool().submit(render_derivatives, source_path, output_dir).result()
+
+        urls = {}
+        for width, path in sorted(outputs.items()):
+            with open(path, 'rb') as data:
+                urls[width] = storage.save(derivative_key(photo_id, width), data)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    thumbnail_url = urls[min(urls)]
+    srcset = ', '.join(f"{url} {width}w" for width, url in sorted(urls.items()))
+    return thumbnail_url, srcset
@@ -0,0 +1,173 @@
+import json
+import os
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+from flask import current_app
+from werkzeug.utils import secure_filename
+from flaskalbum import db
+from flaskalbum.metrics import metrics
+from flaskalbum.models import Photo
+from flaskalbum.storage import LocalStorage, get_storage
+
+# Rows read per round trip, and photos per keyset page of the ZIP export
+EXPORT_BATCH_SIZE = 500
+# Fetched images are kept in memory up to this size, larger ones spill to a temporary file
+SPOOL_BYTES = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+EXPORT_COLUMNS = ('id', 'title', 'description', 'location', 'tags', 'is_favorite', 'upload_date', 'filename', 'image_url', 'thumbnail_url', 'status')
+
+
+def photo_record(row):
+    "JSON-ready dict of a photo row's metadata."
+    record = {column: getattr(row, column) for column in EXPORT_COLUMNS}
+    if isinstance(record['upload_date'], datetime):
+        record['upload_date'] = record['upload_date'].isoformat()
+    return record
+
+
+def export_ndjson(user_id):
+    "Yield a user's photo metadata as newline-delimited JSON, one photo per line, newest first like the album. Rows come from a server-side cursor (yield_per), so memory use does not grow with the album."
+    rows = (
+        db.session.query(*(getattr(Photo, column) for column in EXPORT_COLUMNS))
+        .filter(Photo.user_id == user_id)
+        .order_by(Photo.upload_date.desc(), Photo.id.desc())
+        .yield_per(EXPORT_BATCH_SIZE)
+    )
+    for row in rows:
+        yield json.dumps(photo_record(row)) + '\n'
+
+
+class ZipStream:
+    "Write-only file object ZipFile can write to without seeking. drain() hands out whatever was written since the last call."
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        # Yields nothing rather than an empty chunk, which some servers read as the end of the body
+        if self._chunks:
+            data = b''.join(self._chunks)
+            self._chunks = []
+            yield data
+
+
+def fetch_image(url, timeout, max_bytes):
+    "Download an image into a spooled temporary file and return it rewound. Raises requests.RequestException or ValueError."
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    try:
+        with metrics.track_http(url), requests.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            size = 0
+            for chunk in response.iter_content(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"{url} is larger than {max_bytes} bytes")
+                spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def export_zip(user_id):
+    "Yield a ZIP archive of a user's photos (photos/<id>_<filename>) and their metadata (photos.ndjson). Images are fetched EXPORT_FETCH_WORKERS at a time, at most twice that many ahead of the one being written, and each is copied into the archive in chunks as it is produced. Memory use does not grow with the album; photos that cannot be read are listed in missing.txt."
+    config = current_app.config
+    storage = get_storage()
+    window = 2 * config['EXPORT_FETCH_WORKERS']
+    out = ZipStream()
+    # The metadata goes last, gathered on disk meanwhile
+    metadata = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+    missing = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+
+    def source(photo):
+        # A local file is read in place, anything else is fetched
+        if photo.storage_key and isinstance(storage, LocalStorage):
+            path = storage.path(photo.storage_key)
+            if os.path.exists(path):
+                return lambda: open(path, 'rb')
+        if photo.image_url and photo.image_url.startswith(('http://', 'https://')):
+            return lambda: fetch_image(photo.image_url, config['IMAGE_HOST_TIMEOUT'], config['MAX_PHOTO_SIZE'])
+        return None
+
+    def add_image(photo, future):
+        try:
+            image = future.result()
+        except (OSError, ValueError, requests.RequestException) as e:
+            missing.write(f"{photo.id}\t{photo.filename}\t{e}\n")
+            return
+        name = f"photos/{photo.id}_{secure_filename(photo.filename or '') or 'photo'}"
+        with image, archive.open(zipfile.ZipInfo(name, _date_time(photo.upload_date)), 'w', force_zip64=True) as entry:
+            for chunk in iter(lambda: image.read(CHUNK_SIZE), b''):
+                entry.write(chunk)
+                yield from out.drain()
+
+    pending = []
+    with metadata, missing, ThreadPoolExecutor(max_workers=config['EXPORT_FETCH_WORKERS']) as pool:
+        try:
+            # Photos are stored as they are, JPEGs don't get smaller by deflating
+            with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED) as archive:
+                cursor = None
+                while True:
+                    # Keyset pages instead of one long-running cursor, which the database
+                    # could time out while the export waits on image fetches and the client
+                    photos, cursor = Photo.page_for_user(user_id, cursor=cursor, limit=EXPORT_BATCH_SIZE)
+                    for photo in photos:
+                        metadata.write(json.dumps(photo_record(photo)) + '\n')
+                        opener = source(photo)
+                        if opener is None:
+                            missing.write(f"{photo.id}\t{photo.filename}\tno stored image\n")
+                            continue
+                        pending.append((photo, pool.submit(opener)))
+                        while len(pending) >= window:
+                            yield from add_image(*pending.pop(0))
+                    if cursor is None:
+                        break
+                while pending:
+                    yield from add_image(*pending.pop(0))
+
+                for name, spool in (('photos.ndjson', metadata), ('missing.txt', missing)):
+                    if not spool.tell():
+                        continue
+                    spool.seek(0)
+                    info = zipfile.ZipInfo(name, _date_time(datetime.now()))
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    with archive.open(info, 'w') as entry:
+                        for chunk in iter(lambda: spool.read(CHUNK_SIZE), ''):
+                            entry.write(chunk.encode('utf-8'))
+                            yield from out.drain()
+            yield from out.drain()
+        finally:
+            # The client went away: close what was fetched ahead and not written
+            for _, future in pending:
+                if not future.cancel() and future.exception() is None:
+                    future.result().close()
+
+
+def _date_time(value):
+    value = value or datetime.now()
+    # ZIP timestamps start in 1980
+    return max(value, datetime(1980, 1, 1)).timetuple()[:6]
+
+
+def copy_stream(chunks, fileobj):
+    "Write the chunks of export_ndjson() or export_zip() to a file object."
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        fileobj.write(chunk)
+
+
+def export_filename(user, format):
+    return f"{secure_filename(user.username or user.id) or 'album'}-{datetime.now():%Y%m%d}.{format}"
@@ -0,0 +1,42 @@
+import hashlib
+import os
+from flask import current_app
+from markupsafe import Markup
+from flaskalbum.cache import TTLCache
+
+
+def fragment_cache():
+    "LRU cache of rendered photo cards of the current app, created on first use."
+    cache = current_app.extensions.get('flaskalbum.fragments')
+    if cache is None:
+        cache = TTLCache(current_app.config['FRAGMENT_CACHE_SIZE'], ttl=current_app.config['FRAGMENT_CACHE_TTL'])
+        current_app.extensions['flaskalbum.fragments'] = cache
+    return cache
+
+
+def photo_card(photo, version=None):
+    "Render the gallery card of a photo (a Photo.to_dict() dict). Cards are cached per (photo id, album version); any change to the album bumps the version, so a cached card is never stale."
+    template = current_app.jinja_env.get_template('partials/photo_card.html')
+    if version is None:
+        return Markup(template.render(photo=photo))
+
+    cache = fragment_cache()
+    key = (photo['id'], version)
+    html = cache.get(key)
+    if html is None:
+        html = Markup(template.render(photo=photo))
+        cache.set(key, html)
+    return html
+
+
+def templates_fingerprint():
+    "Short hash of the template files' modification times, part of every page ETag so a deploy with changed templates invalidates cached pages."
+    fingerprint = current_app.extensions.get('flaskalbum.templates_fingerprint')
+    if fingerprint is None:
+        digest = hashlib.sha1()
+        for directory, _, filenames in sorted(os.walk(os.path.join(current_app.root_path, current_app.template_folder))):
+            for filename in sorted(filenames):
+                digest.update(f"{filename}:{os.path.getmtime(os.path.join(directory, filename))}".encode('utf-8'))
+        fingerprint = digest.hexdigest()[:12]
+        current_app.extensions['flaskalbum.templates_fingerprint'] = fingerprint
+    return fingerprint
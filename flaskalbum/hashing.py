@@ -0,0 +1,84 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt as _bcrypt
+from flaskalbum import bcrypt
+from flaskalbum.metrics import metrics
+
+
+class HasherBusy(Exception):
+    "Too many password hashes are already running or waiting."
+
+
+class PasswordHasher:
+    "Runs bcrypt hash and check calls on a small bounded thread pool. bcrypt releases the GIL, so request threads stay responsive while hashes run, and no more than workers hashes burn CPU at once. When workers + max_pending calls are already in flight, further callers wait up to wait_timeout seconds and then get HasherBusy instead of piling up."
+
+    def __init__(self, app=None):
+        self.rounds = 12
+        self._pool = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = app.config['BCRYPT_WORKERS']
+        self.wait_timeout = app.config['BCRYPT_WAIT_TIMEOUT']
+        self._slots = threading.BoundedSemaphore(self.workers + app.config['BCRYPT_MAX_PENDING'])
+
+        if app.config.get('BCRYPT_TARGET_MS'):
+            self.rounds = calibrate_rounds(app.config['BCRYPT_TARGET_MS'], min_rounds=app.config['BCRYPT_MIN_ROUNDS'])
+            app.logger.info(f"bcrypt cost calibrated to {self.rounds} rounds")
+        else:
+            self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+
+    def _run(self, operation, fn, *args):
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise HasherBusy()
+        try:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+            return self._pool.submit(_timed, operation, fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        "Hash a password at the current cost. Raises HasherBusy."
+        return self._run('hash', bcrypt.generate_password_hash, password, self.rounds).decode('utf-8')
+
+    def check(self, pw_hash, password):
+        "Check a password against a stored hash. Raises HasherBusy."
+        return self._run('check', bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        "Whether a stored hash ($2b$<cost>$...) was made at a lower cost than the current one."
+        try:
+            return int(pw_hash.split('$')[2]) < self.rounds
+        except (AttributeError, IndexError, ValueError):
+            return False
+
+
+def _timed(operation, fn, *args):
+    # Runs on the pool, so the time excludes waiting for a free worker
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        metrics.bcrypt.observe(time.perf_counter() - start, operation)
+
+
+def calibrate_rounds(target_ms, min_rounds=10, max_rounds=16):
+    "Return the highest bcrypt cost whose hash still takes no longer than target_ms on this machine (but at least min_rounds). Each extra round doubles the time, so one timed hash is enough."
+    start = time.perf_counter()
+    _bcrypt.hashpw(b'calibration', _bcrypt.gensalt(min_rounds))
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    rounds = min_rounds
+    while rounds < max_rounds and elapsed_ms * 2 <= target_ms:
+        rounds += 1
+        elapsed_ms *= 2
+    return rounds
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,106 @@
+import io
+import os
+import random
+import time
+import uuid
+import requests
+from flask import current_app
+from flaskalbum.metrics import metrics
+
+
+class ImageHostError(Exception):
+    "The image host rejected an upload or could not be reached."
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class MultipartStream:
+    "A multipart/form-data request body that reads the file part from its file object in chunks as it is sent, instead of building the whole body in memory the way requests' files= argument does."
+
+    def __init__(self, fields, file_field, filename, fileobj):
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+
+        head = b''
+        for name, value in fields.items():
+            head += (
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n'
+            ).encode('utf-8')
+        head += (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+        # Size of the rest of the file, so the request can carry a Content-Length
+        start = fileobj.tell()
+        file_size = fileobj.seek(0, os.SEEK_END) - start
+        fileobj.seek(start)
+
+        self._parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+        self._length = len(head) + file_size + len(tail)
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+
+def upload_image(filename, fileobj):
+    "Upload an image to the image host (freeimage.host, or the stand-in configured in IMAGE_HOST_URL) and return its URL. The file is streamed from fileobj, never read into memory whole."
+    payload = {'key': current_app.config['IMG_API_KEY'] or '', 'action': 'upload'}
+    body = MultipartStream(payload, 'source', filename, fileobj)
+
+    try:
+        with metrics.track_http(current_app.config['IMAGE_HOST_URL']):
+            response = requests.post(
+                current_app.config['IMAGE_HOST_URL'],
+                data=body,
+                headers={'Content-Type': body.content_type},
+                timeout=current_app.config['IMAGE_HOST_TIMEOUT'],
+            )
+    except requests.RequestException as e:
+        raise ImageHostError(f"Image host unreachable: {e}") from e
+
+    try:
+        response_data = response.json()
+    except ValueError:
+        response_data = {}
+
+    if response.status_code == 200 and response_data.get('status_code') == 200:
+        return response_data['image']['url']
+
+    # Server errors and rate limiting are worth another try, anything else is a rejected upload
+    retryable = response.status_code >= 500 or response.status_code == 429
+    raise ImageHostError(f"Image host upload failed ({response.status_code}): {response_data}", retryable=retryable)
+
+
+def upload_image_with_retries(filename, data, attempts=None, backoff=None):
+    "Upload a seekable binary file, retrying transient failures with exponential backoff and jitter."
+    attempts = attempts or current_app.config['IMAGE_HOST_RETRIES']
+    backoff = backoff if backoff is not None else current_app.config['IMAGE_HOST_BACKOFF']
+
+    for attempt in range(attempts):
+        try:
+            data.seek(0)
+            return upload_image(filename, data)
+        except ImageHostError as e:
+            if not e.retryable or attempt == attempts - 1:
+                raise
+            current_app.logger.warning(f"Upload of {filename} failed (attempt {attempt + 1}/{attempts}): {e}")
+            time.sleep(backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
@@ -0,0 +1,202 @@
+import base64
+import hashlib
+import hmac
+import os
+import tempfile
+import threading
+import requests
+from flask import current_app, url_for
+from flaskalbum.metrics import metrics
+
+CHUNK_SIZE = 64 * 1024
+# Served from our own origin, so only raster formats: an SVG could carry scripts
+IMAGE_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/avif')
+image_cache_lock = threading.Lock()
+
+
+class ImageFetchError(Exception):
+    "The remote image could not be fetched, or is not an image."
+
+
+class DiskImageCache:
+    "Size-bounded LRU cache of remote images on disk. Each URL is fetched once: concurrent requests for the same uncached URL wait for the first one (single flight) instead of all going to the remote host. Hits refresh the modification time of the entry's type file (the image's own mtime, which its ETag and Last-Modified are built from, never changes), and when the cache grows past max_bytes the least recently used files are removed. Files are written atomically, so several worker processes can share the directory."
+
+    def __init__(self, directory, max_bytes, timeout=10, max_image_bytes=20 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.max_image_bytes = max_image_bytes
+        self._lock = threading.Lock()
+        self._fetches = {}
+        self._written = None
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, url):
+        "Return (path, content type) of the cached copy of url, fetching it first if needed. Raises ImageFetchError."
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        cached = self._lookup(key)
+        if cached:
+            return cached
+
+        with self._lock:
+            fetch_lock = self._fetches.setdefault(key, threading.Lock())
+        with fetch_lock:
+            try:
+                # Another request may have fetched it while this one waited
+                return self._lookup(key) or self._fetch(key, url)
+            finally:
+                with self._lock:
+                    self._fetches.pop(key, None)
+
+    def discard(self, url):
+        "Remove the cached copy of url, if there is one."
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        # The type file goes first, so a half-removed entry reads as a miss
+        for path in reversed(self._paths(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _paths(self, key):
+        return os.path.join(self.directory, key), os.path.join(self.directory, f"{key}.type")
+
+    def _lookup(self, key):
+        path, type_path = self._paths(key)
+        try:
+            with open(type_path, encoding='utf-8') as f:
+                content_type = f.read()
+            os.utime(type_path)
+        except OSError:
+            return None
+        # Cached before the type allowlist, fetched (and refused) again
+        if content_type not in IMAGE_TYPES:
+            return None
+        return path, content_type
+
+    def _fetch(self, key, url):
+        path, type_path = self._paths(key)
+        try:
+            with metrics.track_http(url), requests.get(url, stream=True, timeout=self.timeout) as response:
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+                if response.status_code != 200 or content_type not in IMAGE_TYPES:
+                    raise ImageFetchError(f"{url} answered {response.status_code} ({content_type or 'no content type'})")
+
+                size = 0
+                fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.fetch-')
+                try:
+                    with os.fdopen(fd, 'wb') as out:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            size += len(chunk)
+                            if size > self.max_image_bytes:
+                                raise ImageFetchError(f"{url} is larger than {self.max_image_bytes} bytes")
+                            out.write(chunk)
+                    os.replace(temp_path, path)
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+        except requests.RequestException as e:
+            raise ImageFetchError(f"Could not fetch {url}: {e}") from e
+
+        # The type file is written last, its presence marks a complete entry
+        with open(type_path, 'w', encoding='utf-8') as f:
+            f.write(content_type)
+        self._account(size)
+        return path, content_type
+
+    def _account(self, size):
+        with self._lock:
+            if self._written is None:
+                self._written = self.size()
+            else:
+                self._written += size
+            if self._written <= self.max_bytes:
+                return
+            self._written = self._evict()
+
+    def size(self):
+        "Bytes used by cached images."
+        return sum(entry.stat().st_size for entry in self._images())
+
+    def _images(self):
+        # Skips the type files and the temporary files of fetches in progress
+        return [
+            entry for entry in os.scandir(self.directory)
+            if entry.is_file() and not entry.name.endswith('.type') and not entry.name.startswith('.')
+        ]
+
+    def _evict(self):
+        # Remove the least recently used images until the cache is down to 90% of its size
+        entries = self._images()
+        entries.sort(key=self._last_used)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            # The type file goes first, so a half-removed entry reads as a miss
+            for path in reversed(self._paths(entry.name)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= entry.stat().st_size
+        return total
+
+    def _last_used(self, entry):
+        try:
+            return os.stat(self._paths(entry.name)[1]).st_mtime
+        except FileNotFoundError:
+            return 0
+
+
+def get_image_cache():
+    "Return the image cache of the current app, created on first use."
+    cache = current_app.extensions.get('flaskalbum.image_cache')
+    if cache is None:
+        # Locked, two instances would not share their single-flight locks
+        with image_cache_lock:
+            cache = current_app.extensions.get('flaskalbum.image_cache')
+            if cache is None:
+                config = current_app.config
+                cache = DiskImageCache(
+                    config['IMAGE_CACHE_DIR'],
+                    config['IMAGE_CACHE_MAX_MB'] * 1024 * 1024,
+                    timeout=config['IMAGE_PROXY_TIMEOUT'],
+                    max_image_bytes=config['MAX_PHOTO_SIZE'],
+                )
+                current_app.extensions['flaskalbum.image_cache'] = cache
+    return cache
+
+
+def _signature(token):
+    key = current_app.config['SECRET_KEY'].encode('utf-8')
+    return hmac.new(key, token.encode('ascii'), hashlib.sha256).hexdigest()[:32]
+
+
+def proxy_url(url):
+    "URL of the image proxy for a remote image URL. Local URLs, empty values and everything when IMAGE_PROXY is off are returned unchanged. The URL is signed, so the proxy only fetches URLs this app handed out."
+    if not url or not current_app.config['IMAGE_PROXY'] or not url.startswith(('http://', 'https://')):
+        return url
+    token = base64.urlsafe_b64encode(url.encode('utf-8')).decode('ascii').rstrip('=')
+    return url_for('main.image_proxy', signature=_signature(token), token=token)
+
+
+def proxy_srcset(srcset):
+    "proxy_url for every URL of an <img srcset> value."
+    if not srcset:
+        return srcset
+    candidates = []
+    for candidate in srcset.split(','):
+        url, _, descriptor = candidate.strip().partition(' ')
+        candidates.append(f"{proxy_url(url)} {descriptor}".strip())
+    return ', '.join(candidates)
+
+
+def verified_url(signature, token):
+    "Return the remote URL of a proxy URL's parts, or None if the signature does not match."
+    try:
+        if not hmac.compare_digest(signature, _signature(token)):
+            return None
+        return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+    except (TypeError, ValueError, UnicodeError):
+        return None
@@ -0,0 +1,51 @@
+import logging
+import queue
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    "A bounded queue of background jobs drained by a fixed pool of daemon worker threads. The threads start on the first submit, so importing this module never spawns anything."
+
+    def __init__(self, name, workers=4, maxsize=100):
+        self.name = name
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        "Queue fn(*args) to run on a worker thread. Raises queue.Full when the backlog is at its limit."
+        self._start()
+        self._queue.put_nowait((fn, args))
+
+    def full(self):
+        return self._queue.full()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def join(self):
+        "Block until every queued job has finished."
+        self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            fn, args = self._queue.get()
+            try:
+                fn(*args)
+            except Exception:
+                # A failing job must never take its worker thread down with it
+                logger.exception(f"Job {fn.__name__} failed on {self.name}")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,128 @@
+import logging
+import queue
+import random
+import smtplib
+import threading
+import time
+from email.message import EmailMessage
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    "Queue of outgoing emails sent by one background thread. The thread keeps its authenticated SMTP connection open between messages, drains up to batch_size queued messages per round, reconnects and retries with backoff when the connection drops, and closes the connection once the queue has been idle for idle_timeout seconds."
+
+    def __init__(self, app=None):
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._connection = None
+        self.sent = 0
+        self.failed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.host = app.config['MAIL_SERVER']
+        self.port = app.config['MAIL_PORT']
+        self.use_tls = app.config['MAIL_USE_TLS']
+        self.username = app.config['MAIL_USERNAME']
+        self.password = app.config['MAIL_PASSWORD']
+        self.sender = app.config['MAIL_SENDER']
+        self.timeout = app.config['MAIL_TIMEOUT']
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.retries = app.config['MAIL_RETRIES']
+        self.backoff = app.config['MAIL_BACKOFF']
+        self.idle_timeout = app.config['MAIL_IDLE_TIMEOUT']
+        self._queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+
+    def message(self, to, subject, body):
+        "Build a plain text message from the configured sender."
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = to
+        message['Subject'] = subject
+        message.set_content(body)
+        return message
+
+    def send(self, message):
+        "Queue a message and return immediately. Raises queue.Full when the backlog is at its limit."
+        self._start()
+        self._queue.put_nowait(message)
+
+    def join(self):
+        "Block until every queued message was sent or given up on."
+        self._queue.join()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='mail-outbox', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=self.idle_timeout)]
+            except queue.Empty:
+                self._disconnect()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for message in batch:
+                try:
+                    self._deliver(message)
+                    self.sent += 1
+                except Exception:
+                    self.failed += 1
+                    logger.exception(f"Giving up on email to {message['To']}")
+                finally:
+                    self._queue.task_done()
+
+    def _deliver(self, message):
+        for attempt in range(self.retries + 1):
+            try:
+                self._connect().send_message(message)
+                return
+            except smtplib.SMTPRecipientsRefused:
+                # Retrying won't change the server's mind about the address
+                raise
+            except (smtplib.SMTPException, OSError):
+                self._disconnect()
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def _connect(self):
+        if self._connection is None:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                connection.ehlo()
+                if self.use_tls:
+                    connection.starttls()
+                    connection.ehlo()
+                if self.username:
+                    connection.login(self.username, self.password)
+            except Exception:
+                connection.close()
+                raise
+            self._connection = connection
+        return self._connection
+
+    def _disconnect(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except (smtplib.SMTPException, OSError):
+                self._connection.close()
+            self._connection = None
+
+
+outbox = Outbox()
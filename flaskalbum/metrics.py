@@ -0,0 +1,158 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+MAX_LOGGED_QUERIES = 50
+
+logger = logging.getLogger(__name__)
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    "Prometheus histogram: bucket counts, sum and count for each combination of label values."
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {values[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+def sample(name, help, kind, values, labels=()):
+    "Prometheus text lines of a counter or gauge read from elsewhere: values maps label value tuples to numbers."
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for label_values, value in values.items():
+        lines.append(f"{name}{_labels(labels, label_values)} {value}")
+    return lines
+
+
+class Metrics:
+    "Process-wide timings of requests, the SQL they run, outbound HTTP calls and bcrypt, exported in the Prometheus text format. Requests over SLOW_REQUEST_MS are logged with their SQL statements. Each gunicorn worker keeps its own numbers."
+
+    def __init__(self, app=None):
+        self.requests = Histogram('flaskalbum_request_duration_seconds', 'Request latency by route.', ('method', 'route', 'status'))
+        self.request_queries = Histogram('flaskalbum_request_queries', 'SQL statements run per request, by route.', ('route',), QUERY_COUNT_BUCKETS)
+        self.request_sql = Histogram('flaskalbum_request_sql_seconds', 'Time spent in SQL per request, by route.', ('route',))
+        self.sql = Histogram('flaskalbum_sql_duration_seconds', 'SQL statement latency, in requests and in background jobs.', ('context',))
+        self.http = Histogram('flaskalbum_http_client_duration_seconds', 'Outbound HTTP latency by upstream host.', ('host', 'outcome'))
+        self.bcrypt = Histogram('flaskalbum_bcrypt_duration_seconds', 'bcrypt hash and check time.', ('operation',))
+        self.slow_request_ms = 0
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.slow_request_ms = app.config['SLOW_REQUEST_MS']
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        if not self._listening:
+            # Every engine, including the admin app's and the one of each worker process
+            event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+            self._listening = True
+
+    def _start_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_sql_seconds = 0.0
+        g.metrics_statements = [] if self.slow_request_ms else None
+
+    def _finish_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        # The rule, not the path, so photo ids and tokens don't each get their own series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        self.requests.observe(elapsed, request.method, route, response.status_code)
+        self.request_queries.observe(g.metrics_queries, route)
+        self.request_sql.observe(g.metrics_sql_seconds, route)
+
+        if self.slow_request_ms and elapsed * 1000 >= self.slow_request_ms:
+            lines = [
+                f"Slow request: {request.method} {request.full_path.rstrip('?')} took {elapsed * 1000:.0f} ms, "
+                f"{g.metrics_queries} SQL statements in {g.metrics_sql_seconds * 1000:.0f} ms"
+            ]
+            lines += [f"  {ms:8.1f} ms  {statement}" for ms, statement in g.metrics_statements]
+            if g.metrics_queries > len(g.metrics_statements):
+                lines.append(f"  ... {g.metrics_queries - len(g.metrics_statements)} more")
+            logger.warning('\n'.join(lines))
+        return response
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context.metrics_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.metrics_start
+        in_request = has_request_context() and 'metrics_queries' in g
+        self.sql.observe(elapsed, 'request' if in_request else 'background')
+        if in_request:
+            g.metrics_queries += 1
+            g.metrics_sql_seconds += elapsed
+            if g.metrics_statements is not None and len(g.metrics_statements) < MAX_LOGGED_QUERIES:
+                g.metrics_statements.append((elapsed * 1000, ' '.join(statement.split())))
+
+    @contextmanager
+    def track_http(self, url):
+        "Time the outbound HTTP call made in the with block, labelled with the host of url."
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            self.http.observe(time.perf_counter() - start, urlsplit(url).hostname or 'unknown', outcome)
+
+    def render(self):
+        "The histograms in the Prometheus text format."
+        lines = []
+        for histogram in (self.requests, self.request_queries, self.request_sql, self.sql, self.http, self.bcrypt):
+            lines.extend(histogram.render())
+        return lines
+
+
+metrics = Metrics()
@@ -1,14 +1,35 @@
+import base64
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
 import random
+import re
+import uuid
 from flask_login import UserMixin
-from flaskalbum import app
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from flask import current_app
 import jwt
 
 # Replace 'db' with your SQLAlchemy instance import
 from flaskalbum import db, bcrypt
+from flaskalbum.cache import ObjectCache
+from flaskalbum.derivatives import DERIVATIVE_WIDTHS, derivative_key
+from flaskalbum.hashing import password_hasher
+from flaskalbum.storage import delete_later
 USER_INFO_TABLE = os.getenv('USER_INFO_TABLE')
 PHOTO_INFO_TABLE = os.getenv('PHOTO_INFO_TABLE')
+TAG_INFO_TABLE = os.getenv('TAG_INFO_TABLE', 'tag_info')
+ALBUM_STATS_TABLE = os.getenv('ALBUM_STATS_TABLE', 'album_stats')
+
+# Photos deleted per transaction when deleting accounts
+DELETE_CHUNK_SIZE = 1000
+
+# Profile columns of logged-in users, keyed by user id. The password hash is left out.
+# Sized and connected to the shared backend by create_app.
+user_cache = ObjectCache('user')
+CACHED_USER_COLUMNS = ('id', 'username', 'name', 'email', 'profile_photo')
 
 class User(db.Model, UserMixin):
     #User model for handling authentication and user management.
@@ -22,11 +43,33 @@ class User(db.Model, UserMixin):
     profile_photo = db.Column(db.String(500))
 
     # Relationship with photos (one-to-many) - Keep if you need it
-    photos = db.relationship('Photo', backref=USER_INFO_TABLE, lazy=True, cascade='all, delete-orphan')
+    # passive_deletes: deleting a user leaves the photos to the database's ON DELETE CASCADE
+    # instead of loading them all; delete_accounts() removes them in chunks first anyway
+    photos = db.relationship('Photo', backref=USER_INFO_TABLE, lazy=True, cascade='all, delete-orphan', passive_deletes=True)
+    album_stats = db.relationship('AlbumStats', uselist=False, lazy=True, cascade='all, delete-orphan', passive_deletes=True)
 
     def get_id(self):
         return str(self.id)
 
+    @classmethod
+    def load(cls, user_id):
+        "Load a user for Flask-Login. Cached users are attached to the session without a query; columns left out of the cache are loaded if something reads them."
+        data = user_cache.get(user_id)
+        if data is None:
+            user = db.session.get(cls, user_id)
+            if user is not None:
+                user_cache.set(user_id, {column: getattr(user, column) for column in CACHED_USER_COLUMNS})
+            return user
+
+        user = cls(**data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    @staticmethod
+    def invalidate_cache(user_id):
+        "Drop a user from the cache. Call after changing any of its cached columns."
+        user_cache.delete(user_id)
+
     @property
     def is_authenticated(self):
         return True
@@ -64,13 +107,8 @@ class User(db.Model, UserMixin):
 
     @staticmethod
     def register(data):
-        "Register a new user. First checks if the username and email already exist in the database. If not, it hashes the password and adds the new user to the database."
-        if User.query.filter_by(username=data['username']).first():
-            return -1
-        if User.query.filter_by(email=data['email']).first():
-            return -2
-
-        hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8')
+        "Register a new user with a single INSERT, letting the unique constraints on username and email reject duplicates. Returns 1 on success, -1 if the username exists, -2 if the email exists and 0 on any other failure."
+        hashed_password = password_hasher.hash(data['password'])
         new_user = User(
             id=data['id'],
             name=data['name'],
@@ -83,22 +121,117 @@ class User(db.Model, UserMixin):
             db.session.add(new_user)
             db.session.commit()
             return 1
+        except IntegrityError as e:
+            db.session.rollback()
+            return User.duplicate_result(e, data)
         except Exception as e:
             db.session.rollback()
             
             return 0
 
+    @staticmethod
+    def duplicate_result(error, data):
+        "Map a unique constraint violation to the -1 (username) / -2 (email) results of register."
+        message = str(error.orig)
+        # MySQL: "Duplicate entry 'x' for key 'user_info.username'", SQLite: "UNIQUE constraint failed: user_info.username"
+        key = re.search(r"for key '([^']+)'|constraint failed: (\S+)", message)
+        column = (key.group(1) or key.group(2)).rsplit('.', 1)[-1] if key else None
+        if column == 'username':
+            return -1
+        if column == 'email':
+            return -2
+        if column is None:
+            # Unknown driver message, find out with one lookup
+            if User.query.filter_by(username=data['username']).first():
+                return -1
+            if User.query.filter_by(email=data['email']).first():
+                return -2
+        return 0
+
+    @staticmethod
+    def bulk_register(users, batch_size=500, workers=8):
+        "Provision many users at once: users is an iterable of dicts with name, email, username and password. Usernames and emails that already exist (or repeat) are skipped. Passwords are hashed in parallel and every batch is inserted with one multi-row INSERT. Returns (created, skipped)."
+        created = skipped = 0
+        seen_usernames, seen_emails = set(), set()
+
+        # Offline job: hash on its own pool instead of competing for the request hasher's slots
+        def hash_password(password):
+            return bcrypt.generate_password_hash(password, password_hasher.rounds).decode('utf-8')
+
+        def flush(batch):
+            nonlocal skipped
+            taken = db.session.query(User.username, User.email).filter(
+                User.username.in_([user['username'] for user in batch]) |
+                User.email.in_([user['email'] for user in batch])
+            ).all()
+            taken_usernames = {username for username, _ in taken}
+            taken_emails = {email for _, email in taken}
+            new_users = [
+                user for user in batch
+                if user['username'] not in taken_usernames and user['email'] not in taken_emails
+            ]
+            skipped += len(batch) - len(new_users)
+            if not new_users:
+                return 0
+
+            # bcrypt releases the GIL, so threads hash in parallel
+            hashes = list(pool.map(hash_password, [user['password'] for user in new_users]))
+            db.session.execute(db.insert(User), [
+                {
+                    'id': uuid.uuid4().hex,
+                    'name': user['name'],
+                    'email': user['email'],
+                    'username': user['username'],
+                    'password': password_hash
+                }
+                for user, password_hash in zip(new_users, hashes)
+            ])
+            db.session.commit()
+            return len(new_users)
+
+        batch = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for user in users:
+                if user['username'] in seen_usernames or user['email'] in seen_emails:
+                    skipped += 1
+                    continue
+                seen_usernames.add(user['username'])
+                seen_emails.add(user['email'])
+                batch.append(user)
+                if len(batch) >= batch_size:
+                    created += flush(batch)
+                    batch = []
+            if batch:
+                created += flush(batch)
+        return created, skipped
+
     @classmethod
     def authenticate_user(cls, username, password):
-        "If username/email exists and password is correct, return the user object."
+        "If username/email exists and password is correct, return the user object. Hashes made at an older, lower cost are upgraded on the way. Raises HasherBusy."
+        return cls.authenticate(cls.find_for_login(username), password)
 
-        user = cls.query.filter(
+    @classmethod
+    def find_for_login(cls, username):
+        "The user whose username or email is username (the login form takes either), or None."
+        return cls.query.filter(
             (cls.username == username) | (cls.email == username)
         ).first()
 
-        if user and bcrypt.check_password_hash(user.password, password):
-            return user
-        return None
+    @staticmethod
+    def authenticate(user, password):
+        "Return user if it is not None and password is correct. Hashes made at an older, lower cost are upgraded on the way. Raises HasherBusy."
+        if not (user and user.password and password_hasher.check(user.password, password)):
+            return None
+
+        if password_hasher.needs_rehash(user.password):
+            try:
+                user.password = password_hasher.hash(password)
+                db.session.commit()
+            except Exception as e:
+                # The login itself succeeded, the upgrade is retried next time
+                db.session.rollback()
+                current_app.logger.warning(f"Could not upgrade password hash of {user.username}: {e}")
+        return user
 
     def get_reset_token(self, expires_sec=600):
         expiration_time = (datetime.now() + timedelta(seconds=expires_sec)).isoformat()
@@ -108,7 +241,7 @@ class User(db.Model, UserMixin):
         }
         return jwt.encode(
             payload,
-            app.config['SECRET_KEY'],
+            current_app.config['SECRET_KEY'],
             algorithm='HS256'
         )
 
@@ -117,7 +250,7 @@ class User(db.Model, UserMixin):
         try:
             payload = jwt.decode(
                 token,
-                app.config['SECRET_KEY'],
+                current_app.config['SECRET_KEY'],
                 algorithms=['HS256']
             )
             email = payload['email']
@@ -138,8 +271,9 @@ class User(db.Model, UserMixin):
     def update_password(cls, email, password):
         user = cls.query.filter_by(email=email).first()
         if user:
-            user.password = bcrypt.generate_password_hash(password).decode('utf-8')
+            user.password = password_hasher.hash(password)
             db.session.commit()
+            User.invalidate_cache(user.id)
             return True
         return False
 
@@ -150,21 +284,53 @@ class User(db.Model, UserMixin):
             user.name = name
             user.email = email
             db.session.commit()
+            User.invalidate_cache(user.id)
             return True
         except Exception as e:
             db.session.rollback()
-            print(e)
+            current_app.logger.error(f"Could not update user {username}: {e}")
             return False
 
-    def delete_account(self, username):
-        try:
-            user_to_delete = User.query.filter_by(username=username).first()
-            db.session.delete(user_to_delete)
+    @classmethod
+    def delete_accounts(cls, user_ids, chunk_size=DELETE_CHUNK_SIZE):
+        "Delete users with their photos, tag links and stats using set-based statements, without loading a single photo. Photos go chunk_size at a time, each chunk in its own transaction so no statement holds its locks for long, and the users go last. Their stored files are removed by a background job. Commits; returns the number of users deleted."
+        from flaskalbum.search import get_search_backend
+        user_ids = list(user_ids)
+        while True:
+            rows = (
+                db.session.query(Photo.id, Photo.user_id, Photo.storage_key, Photo.image_url, Photo.thumbnail_url, Photo.srcset)
+                .filter(Photo.user_id.in_(user_ids))
+                .limit(chunk_size)
+                .all()
+            )
+            if not rows:
+                break
+            for user_id in sorted({row.user_id for row in rows}):
+                AlbumStats.lock(user_id)
+            ids = [row.id for row in rows]
+            db.session.execute(photo_tags.delete().where(photo_tags.c.photo_id.in_(ids)))
+            db.session.query(Photo).filter(Photo.id.in_(ids)).delete(synchronize_session=False)
             db.session.commit()
-            return True
+            delete_later(*stored_files(rows))
+
+        db.session.query(AlbumStats).filter(AlbumStats.user_id.in_(user_ids)).delete(synchronize_session=False)
+        count = db.session.query(cls).filter(cls.id.in_(user_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        search = get_search_backend()
+        for user_id in user_ids:
+            cls.invalidate_cache(user_id)
+            search.remove_user(user_id)
+        return count
+
+    @staticmethod
+    def delete_account(username):
+        try:
+            user_id = db.session.query(User.id).filter_by(username=username).scalar()
+            return User.delete_accounts([user_id]) == 1
         except Exception as e:
             db.session.rollback()
-            print(e)
+            current_app.logger.error(f"Could not delete user {username}: {e}")
             return False
         
     # When printing the object, return the user's username, email, and name
@@ -173,20 +339,489 @@ class User(db.Model, UserMixin):
 
 # ===========================================================================
 
+# Number of photos rendered per gallery page / returned per API call
+PHOTOS_PER_PAGE = int(os.getenv('PHOTOS_PER_PAGE', 24))
+TAG_MAX_LENGTH = 50
+
+
+def parse_tags(tags):
+    "Split a comma separated tags string into unique, lowercased tag names, keeping their order."
+    names = []
+    for name in (tags or '').split(','):
+        name = name.strip().lower()[:TAG_MAX_LENGTH]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+class Tag(db.Model):
+    "A normalized tag name, shared by every photo carrying it."
+    __tablename__ = TAG_INFO_TABLE
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(TAG_MAX_LENGTH), unique=True, nullable=False)
+
+    @classmethod
+    def ids_for(cls, names, create=True):
+        "Return {name: id} for the given tag names, inserting the missing ones when create is set."
+        if not names:
+            return {}
+        ids = dict(db.session.query(cls.name, cls.id).filter(cls.name.in_(names)).all())
+        if create:
+            # In name order, so writers adding the same new tags never lock them in opposite orders
+            for name in sorted(names):
+                if name in ids:
+                    continue
+                try:
+                    # Savepoint, so losing a race against a concurrent insert only undoes this tag
+                    with db.session.begin_nested():
+                        tag = cls(name=name)
+                        db.session.add(tag)
+                    ids[name] = tag.id
+                except IntegrityError:
+                    ids[name] = db.session.query(cls.id).filter_by(name=name).scalar()
+        return ids
+
+    def __repr__(self):
+        return f'<Tag {self.name}>'
+
+
+# Which photo carries which tag. The primary key answers "tags of a photo",
+# the tag_id index answers "photos with a tag".
+photo_tags = db.Table(
+    f'{PHOTO_INFO_TABLE}_tags',
+    db.Column('photo_id', db.String(100), db.ForeignKey(f'{PHOTO_INFO_TABLE}.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey(f'{TAG_INFO_TABLE}.id', ondelete='CASCADE'), primary_key=True),
+    db.Index(f'ix_{PHOTO_INFO_TABLE}_tags_tag_id', 'tag_id', 'photo_id'),
+)
+
 # Database Model (using SQLAlchemy)
 class Photo(db.Model):
     __tablename__ = PHOTO_INFO_TABLE
 
+    # Upload states: pending until a worker has pushed the file to the image host
+    STATUS_PENDING = 'pending'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+
+    # What bulk_edit() can do to many photos at once
+    BULK_ACTIONS = ('delete', 'favorite', 'unfavorite', 'add_tags', 'remove_tags', 'set_location')
+
+    # Composite index backing the keyset pagination of a user's gallery
+    # and the MySQL FULLTEXT index used by search (other databases use an in-process index)
+    __table_args__ = (
+        db.Index(f'ix_{PHOTO_INFO_TABLE}_user_upload_date', 'user_id', 'upload_date', 'id'),
+        db.Index(f'ft_{PHOTO_INFO_TABLE}_text', 'title', 'description', 'location', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
+
     id = db.Column(db.String(100), primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     title = db.Column(db.String(100))
     description = db.Column(db.Text)
-    upload_date = db.Column(db.DateTime, default=datetime.now().astimezone())
-    user_id = db.Column(db.String(50), db.ForeignKey(f'{USER_INFO_TABLE}.id'), nullable=False)
+    upload_date = db.Column(db.DateTime, default=datetime.now)
+    user_id = db.Column(db.String(50), db.ForeignKey(f'{USER_INFO_TABLE}.id', ondelete='CASCADE'), nullable=False)
     image_url = db.Column(db.String(500))
+    storage_key = db.Column(db.String(255))
+    # Resized copies for the gallery grid: the smallest one, and all of them as an <img srcset>
+    thumbnail_url = db.Column(db.String(500))
+    srcset = db.Column(db.Text)
     location = db.Column(db.String(100))
     tags = db.Column(db.String(200))
     is_favorite = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(20), default=STATUS_READY, server_default=STATUS_READY, nullable=False)
+
+    # Normalized copy of the tags string above, kept in sync by sync_tags()
+    tag_index = db.relationship('Tag', secondary=photo_tags, lazy=True)
+
+    def to_dict(self):
+        "Return the photo details used by the gallery templates and the JSON API."
+        return {
+            'id': self.id,
+            'url': self.image_url,
+            'thumbnail_url': self.thumbnail_url,
+            'srcset': self.srcset,
+            'title': self.title,
+            'description': self.description,
+            'location': self.location,
+            'tags': self.tags,
+            'upload_date': self.upload_date,
+            'is_favorite': self.is_favorite,
+            'status': self.status
+        }
+
+    def stats_entry(self):
+        "What this photo contributes to its owner's AlbumStats."
+        return AlbumStats.entry(self.tags, self.location, self.is_favorite)
+
+    @classmethod
+    def delete_many(cls, photo_ids, user_id=None):
+        "Delete photos by id (only those of user_id, when given) with set-based statements, take them out of their owners' stats and the search backend, and queue the removal of their stored files. Commits; returns {user id: [deleted photo ids]}."
+        from flaskalbum.search import get_search_backend
+        deleted = {}
+        removed = {}
+        if user_id is not None:
+            owners = [user_id]
+        else:
+            owners = sorted(owner for owner, in db.session.query(cls.user_id).filter(cls.id.in_(photo_ids)).distinct())
+        for owner in owners:
+            AlbumStats.lock(owner)
+        query = db.session.query(cls.id, cls.user_id, cls.tags, cls.location, cls.is_favorite, cls.storage_key, cls.image_url, cls.thumbnail_url, cls.srcset)
+        if user_id is not None:
+            query = query.filter(cls.user_id == user_id)
+        rows = query.filter(cls.id.in_(photo_ids)).all()
+        if not rows:
+            # Release the album locks
+            db.session.rollback()
+            return deleted
+        for row in rows:
+            deleted.setdefault(row.user_id, []).append(row.id)
+            removed.setdefault(row.user_id, []).append(AlbumStats.entry(row.tags, row.location, row.is_favorite))
+
+        ids = [row.id for row in rows]
+        db.session.execute(photo_tags.delete().where(photo_tags.c.photo_id.in_(ids)))
+        db.session.query(cls).filter(cls.id.in_(ids)).delete(synchronize_session=False)
+        for user_id, entries in removed.items():
+            AlbumStats.record(user_id, removed=entries)
+        db.session.commit()
+
+        search = get_search_backend()
+        for user_id, user_photo_ids in deleted.items():
+            search.remove_photos(user_id, user_photo_ids)
+        delete_later(*stored_files(rows))
+        return deleted
+
+    @classmethod
+    def bulk_edit(cls, user_id, photo_ids, action, value=None):
+        "Apply one of BULK_ACTIONS to those of photo_ids that belong to user_id: value is the tags string for add_tags and remove_tags and the location for set_location. Each action is one ownership-scoped UPDATE or DELETE (plus the tag index changes), photos it would not change are left out, and stats, album version and search index follow. Commits; returns the number of photos changed. Raises ValueError if the new tags of a photo do not fit its column."
+        from flaskalbum.search import get_search_backend
+        if action == 'delete':
+            return sum(len(ids) for ids in cls.delete_many(photo_ids, user_id=user_id).values())
+
+        AlbumStats.lock(user_id)
+        rows = (
+            db.session.query(cls.id, cls.title, cls.description, cls.tags, cls.location, cls.is_favorite)
+            .filter(cls.user_id == user_id, cls.id.in_(photo_ids))
+            .all()
+        )
+        table = cls.__table__
+        owned = table.c.user_id == user_id
+        changes = {}
+        if action in ('favorite', 'unfavorite'):
+            favorite = action == 'favorite'
+            changes = {row.id: {'is_favorite': favorite} for row in rows if bool(row.is_favorite) != favorite}
+            if changes:
+                db.session.execute(table.update().where(owned, table.c.id.in_(changes)).values(is_favorite=favorite))
+        elif action == 'set_location':
+            location = (value or '').strip()
+            changes = {row.id: {'location': location} for row in rows if (row.location or '') != location}
+            if changes:
+                db.session.execute(table.update().where(owned, table.c.id.in_(changes)).values(location=location))
+        elif action in ('add_tags', 'remove_tags'):
+            names = parse_tags(value)
+            for row in rows:
+                current = parse_tags(row.tags)
+                if action == 'add_tags':
+                    new = current + [name for name in names if name not in current]
+                else:
+                    new = [name for name in current if name not in names]
+                if new != current:
+                    tags = ', '.join(new)
+                    if len(tags) > cls.tags.type.length:
+                        db.session.rollback()
+                        raise ValueError(f"Too many tags for photo {row.id}")
+                    changes[row.id] = {'tags': tags}
+            if changes:
+                # One statement, executed for every changed photo
+                db.session.execute(
+                    table.update().where(owned, table.c.id == db.bindparam('photo_id')).values(tags=db.bindparam('new_tags')),
+                    [{'photo_id': photo_id, 'new_tags': change['tags']} for photo_id, change in changes.items()],
+                )
+                cls._bulk_sync_tags(list(changes), names, add=action == 'add_tags')
+        else:
+            db.session.rollback()
+            raise ValueError(f"Unknown bulk action: {action}")
+
+        if not changes:
+            # Nothing was written, only the album lock is released
+            db.session.rollback()
+            return 0
+        def entry(row, **changed):
+            fields = {'tags': row.tags, 'location': row.location, 'is_favorite': row.is_favorite}
+            return AlbumStats.entry(**{**fields, **changed})
+
+        changed_rows = [row for row in rows if row.id in changes]
+        AlbumStats.record(
+            user_id,
+            added=[entry(row, **changes[row.id]) for row in changed_rows],
+            removed=[entry(row) for row in changed_rows],
+        )
+        db.session.commit()
+
+        if action == 'set_location':
+            search = get_search_backend()
+            for row in changed_rows:
+                search.index_photo(row.id, user_id, row.title, row.description, changes[row.id]['location'])
+        return len(changes)
+
+    @staticmethod
+    def _bulk_sync_tags(photo_ids, names, add):
+        # Tag index side of bulk_edit: link or unlink the given tag names on all the photos
+        ids = Tag.ids_for(names, create=add)
+        if not ids:
+            return
+        if not add:
+            db.session.execute(photo_tags.delete().where(photo_tags.c.photo_id.in_(photo_ids), photo_tags.c.tag_id.in_(ids.values())))
+            return
+        linked = set(
+            db.session.query(photo_tags.c.photo_id, photo_tags.c.tag_id)
+            .filter(photo_tags.c.photo_id.in_(photo_ids), photo_tags.c.tag_id.in_(ids.values()))
+            .all()
+        )
+        rows = [
+            {'photo_id': photo_id, 'tag_id': tag_id}
+            for photo_id in photo_ids
+            for tag_id in ids.values()
+            if (photo_id, tag_id) not in linked
+        ]
+        if rows:
+            db.session.execute(photo_tags.insert(), rows)
+
+    @staticmethod
+    def encode_cursor(photo):
+        "Encode the (upload_date, id) position of a photo into an opaque cursor string."
+        raw = f"{photo.upload_date.isoformat()}|{photo.id}"
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        "Decode a cursor back into (upload_date, id). Raises ValueError if it is malformed."
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+            upload_date, photo_id = raw.split('|', 1)
+            return datetime.fromisoformat(upload_date), photo_id
+        except (UnicodeError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+    def sync_tags(self):
+        "Bring the tag index in line with the tags string, adding and removing only the tags that changed."
+        names = parse_tags(self.tags)
+        current = {tag.name: tag for tag in self.tag_index}
+
+        for name, tag in current.items():
+            if name not in names:
+                self.tag_index.remove(tag)
+
+        added = [name for name in names if name not in current]
+        if added:
+            ids = Tag.ids_for(added)
+            self.tag_index.extend(Tag.query.filter(Tag.id.in_(ids.values())).all())
+
+    @staticmethod
+    def index_tags(photo_tags_strings):
+        "Bulk version of sync_tags for photos that have no indexed tags yet: {photo id: tags string}. Inserts every association row with one statement."
+        names = {photo_id: parse_tags(tags) for photo_id, tags in photo_tags_strings.items()}
+        ids = Tag.ids_for(sorted({name for photo_names in names.values() for name in photo_names}))
+        rows = [
+            {'photo_id': photo_id, 'tag_id': ids[name]}
+            for photo_id, photo_names in names.items()
+            for name in photo_names
+        ]
+        if rows:
+            db.session.execute(photo_tags.insert(), rows)
+
+    @classmethod
+    def tagged(cls, query, names):
+        "Restrict a photo query to photos carrying every one of the given tag names, through the tag index."
+        names = parse_tags(','.join(names))
+        ids = Tag.ids_for(names, create=False)
+        if len(ids) < len(names):
+            # A tag nobody uses cannot match anything
+            return query.filter(db.false())
+        for tag_id in ids.values():
+            query = query.filter(
+                db.session.query(photo_tags.c.photo_id)
+                .filter(photo_tags.c.photo_id == cls.id, photo_tags.c.tag_id == tag_id)
+                .exists()
+            )
+        return query
+
+    @classmethod
+    def page_for_user(cls, user_id, cursor=None, limit=PHOTOS_PER_PAGE, tags=None):
+        "Return one page of a user's photos (optionally only those with all the given tags), newest first, and the cursor of the next page (None on the last page)."
+        query = cls.query.filter(cls.user_id == user_id)
+        if tags:
+            query = cls.tagged(query, tags)
+        if cursor:
+            upload_date, photo_id = cls.decode_cursor(cursor)
+            # Seek past the last row of the previous page instead of using OFFSET
+            query = query.filter(
+                (cls.upload_date < upload_date) |
+                ((cls.upload_date == upload_date) & (cls.id < photo_id))
+            )
+
+        # Fetch one extra row to find out whether another page exists
+        photos = query.order_by(cls.upload_date.desc(), cls.id.desc()).limit(limit + 1).all()
+        next_cursor = None
+        if len(photos) > limit:
+            photos = photos[:limit]
+            next_cursor = cls.encode_cursor(photos[-1])
+        return photos, next_cursor
 
     def __repr__(self):
-        return f'<Photo {self.filename}>'
\ No newline at end of file
+        return f'<Photo {self.filename}>'
+
+
+class AlbumStats(db.Model):
+    "Per-user photo and favorite counts and tag and location histograms. Kept up to date by record() in the same transaction as every change to the user's photos, so reading them is a single primary key lookup; the reconcile-stats command rebuilds them from the photos."
+    __tablename__ = ALBUM_STATS_TABLE
+
+    user_id = db.Column(db.String(100), db.ForeignKey(f'{USER_INFO_TABLE}.id', ondelete='CASCADE'), primary_key=True)
+    photo_count = db.Column(db.Integer, default=0, nullable=False)
+    favorite_count = db.Column(db.Integer, default=0, nullable=False)
+    # {tag name: number of photos}, {location: number of photos}
+    tag_counts = db.Column(db.JSON, default=dict, nullable=False)
+    location_counts = db.Column(db.JSON, default=dict, nullable=False)
+    # Bumped by every change to the album, including upload results. Pages and
+    # fragments rendered from the album are cached and validated against it.
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    @staticmethod
+    def entry(tags, location, is_favorite=False):
+        "What one photo with these details contributes to the stats."
+        return {
+            'tags': parse_tags(tags),
+            'location': (location or '').strip(),
+            'is_favorite': bool(is_favorite),
+        }
+
+    @classmethod
+    def get(cls, user_id):
+        "Return a user's stats, or empty stats for a user without any (not added to the session)."
+        return db.session.get(cls, user_id) or cls._empty(user_id)
+
+    @classmethod
+    def version_of(cls, user_id):
+        "Current version of a user's album, reading nothing else."
+        return db.session.query(cls.version).filter_by(user_id=user_id).scalar() or 0
+
+    @classmethod
+    def _empty(cls, user_id):
+        return cls(user_id=user_id, photo_count=0, favorite_count=0, tag_counts={}, location_counts={}, version=0)
+
+    @classmethod
+    def lock(cls, user_id):
+        "Lock a user's stats row until the transaction ends and return it, so concurrent changes to one album apply one after the other. Every writer takes it before touching any tag or photo row (and several albums in user id order), so two of them never wait on each other's locks; pending changes are not flushed ahead of it."
+        with db.session.no_autoflush:
+            stats = db.session.query(cls).filter_by(user_id=user_id).with_for_update().populate_existing().first()
+        if stats is None:
+            try:
+                with db.session.begin_nested():
+                    stats = cls._empty(user_id)
+                    db.session.add(stats)
+            except IntegrityError:
+                stats = db.session.query(cls).filter_by(user_id=user_id).with_for_update().populate_existing().one()
+        return stats
+
+    @classmethod
+    def record(cls, user_id, added=(), removed=()):
+        "Apply photos added to and removed from a user's album, as entry() dicts. An edit is the old entry removed and the new one added. Does not commit; call it in the transaction that changes the photos, after taking lock()."
+        if not added and not removed:
+            return
+        stats = cls.lock(user_id)
+        stats.apply(added, removed)
+        stats.version += 1
+
+    @classmethod
+    def bump(cls, user_id):
+        "Mark a user's album as changed without changing its counts, e.g. when an upload finishes. Does not commit."
+        cls.lock(user_id).version += 1
+
+    def apply(self, added=(), removed=()):
+        tag_counts = dict(self.tag_counts or {})
+        location_counts = dict(self.location_counts or {})
+        for entries, delta in ((added, 1), (removed, -1)):
+            for entry in entries:
+                self.photo_count += delta
+                if entry['is_favorite']:
+                    self.favorite_count += delta
+                for name in entry['tags']:
+                    _add_count(tag_counts, name, delta)
+                if entry['location']:
+                    _add_count(location_counts, entry['location'], delta)
+
+        # Assign new dicts, in-place changes to a JSON column are not detected
+        self.tag_counts = tag_counts
+        self.location_counts = location_counts
+
+    @classmethod
+    def rebuild(cls, user_ids):
+        "Recompute the stats of the given users from their photos, replacing what is stored. Does not commit."
+        stats = {}
+        for user_id in user_ids:
+            stats[user_id] = cls.lock(user_id)
+            stats[user_id].photo_count = stats[user_id].favorite_count = 0
+        tag_counts = {user_id: Counter() for user_id in user_ids}
+        location_counts = {user_id: Counter() for user_id in user_ids}
+
+        rows = (
+            db.session.query(Photo.user_id, Photo.tags, Photo.location, Photo.is_favorite)
+            .filter(Photo.user_id.in_(user_ids))
+            .yield_per(1000)
+        )
+        for user_id, tags, location, is_favorite in rows:
+            entry = cls.entry(tags, location, is_favorite)
+            stats[user_id].photo_count += 1
+            stats[user_id].favorite_count += entry['is_favorite']
+            tag_counts[user_id].update(entry['tags'])
+            if entry['location']:
+                location_counts[user_id][entry['location']] += 1
+
+        for user_id in user_ids:
+            stats[user_id].tag_counts = dict(tag_counts[user_id])
+            stats[user_id].location_counts = dict(location_counts[user_id])
+            stats[user_id].version += 1
+
+    def top_tags(self, limit=10):
+        "The most used tags as (name, count) pairs."
+        return _top(self.tag_counts, limit)
+
+    def top_locations(self, limit=10):
+        "The most used locations as (location, count) pairs."
+        return _top(self.location_counts, limit)
+
+    def to_dict(self, limit=10):
+        return {
+            'photo_count': self.photo_count,
+            'favorite_count': self.favorite_count,
+            'top_tags': self.top_tags(limit),
+            'top_locations': self.top_locations(limit),
+        }
+
+    def __repr__(self):
+        return f'<AlbumStats {self.user_id}: {self.photo_count} photos>'
+
+
+def stored_files(rows):
+    "Storage keys (the original and its resized copies) and image URLs of photo rows with id, storage_key, image_url, thumbnail_url and srcset, for delete_later()."
+    keys = []
+    urls = []
+    for row in rows:
+        if row.storage_key:
+            keys.append(row.storage_key)
+        keys.extend(derivative_key(row.id, width) for width in DERIVATIVE_WIDTHS)
+        urls.extend(url for url in (row.image_url, row.thumbnail_url) if url)
+        urls.extend(candidate.split()[0] for candidate in (row.srcset or '').split(',') if candidate.strip())
+    return keys, urls
+
+
+def _add_count(counts, key, delta):
+    count = counts.get(key, 0) + delta
+    if count > 0:
+        counts[key] = count
+    else:
+        counts.pop(key, None)
+
+
+def _top(counts, limit):
+    return sorted((counts or {}).items(), key=lambda item: (-item[1], item[0]))[:limit]
@@ -0,0 +1,183 @@
+import json
+import re
+import threading
+import time
+import jwt
+import requests
+from flask import current_app
+from oauthlib.oauth2 import WebApplicationClient
+from flaskalbum.metrics import metrics
+
+# Used when the provider does not send a Cache-Control max-age
+DEFAULT_MAX_AGE = 3600
+# A stale copy is served (while refreshing in the background) for at most this long
+MAX_STALE = 24 * 3600
+# Minimum seconds between forced JWKS refreshes triggered by an unknown key id
+MIN_KEY_REFRESH_INTERVAL = 60
+REQUEST_TIMEOUT = 10
+
+
+def cache_lifetime(response, default=DEFAULT_MAX_AGE):
+    "Return how many seconds a response may be cached for according to its Cache-Control and Age headers."
+    cache_control = response.headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+
+    max_age = re.search(r'max-age=(\d+)', cache_control)
+    if not max_age:
+        return default
+
+    try:
+        age = int(response.headers.get('Age', 0))
+    except ValueError:
+        age = 0
+    return max(0, int(max_age.group(1)) - age)
+
+
+class CachedDocument:
+    "A JSON document fetched over HTTP and kept for as long as its Cache-Control header allows. Once it goes stale the old copy keeps being served while a background thread fetches a fresh one."
+
+    def __init__(self, url, timeout=REQUEST_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self._value = None
+        self._fetched_at = 0.0
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self):
+        now = time.monotonic()
+        with self._lock:
+            value, fetched_at, expires_at = self._value, self._fetched_at, self._expires_at
+
+        # Nothing cached yet, or too old to serve: the caller has to wait for the fetch
+        if value is None or now - fetched_at > MAX_STALE:
+            return self.refresh()
+
+        if now >= expires_at:
+            self._refresh_in_background()
+        return value
+
+    def refresh(self):
+        "Fetch the document now, store it and return it."
+        with metrics.track_http(self.url):
+            response = requests.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        value = response.json()
+
+        now = time.monotonic()
+        with self._lock:
+            self._value = value
+            self._fetched_at = now
+            self._expires_at = now + cache_lifetime(response)
+        return value
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except (requests.RequestException, ValueError):
+            # Keep serving the stale copy, the next request after expiry tries again
+            pass
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+class OpenIDProvider:
+    "Process-wide cache of an OpenID Connect provider's discovery document and signing keys, used to verify ID tokens locally."
+
+    def __init__(self, discovery_url, client_id):
+        self.client_id = client_id
+        self.discovery = CachedDocument(discovery_url)
+        self._jwks = None
+        self._jwks_lock = threading.Lock()
+        self._last_key_refresh = 0.0
+
+    def config(self):
+        "Return the provider's discovery document (authorization, token, userinfo and jwks endpoints)."
+        return self.discovery.get()
+
+    def jwks(self):
+        jwks_uri = self.config()['jwks_uri']
+        with self._jwks_lock:
+            if self._jwks is None or self._jwks.url != jwks_uri:
+                self._jwks = CachedDocument(jwks_uri)
+            return self._jwks
+
+    def signing_key(self, kid):
+        "Return the public key with the given key id, refreshing the key set once if the provider rotated its keys."
+        jwks = self.jwks()
+        key = self._find_key(jwks.get(), kid)
+        if key is None and time.monotonic() - self._last_key_refresh > MIN_KEY_REFRESH_INTERVAL:
+            self._last_key_refresh = time.monotonic()
+            key = self._find_key(jwks.refresh(), kid)
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown signing key: {kid!r}")
+        return key
+
+    @staticmethod
+    def _find_key(key_set, kid):
+        for key in key_set.get('keys', []):
+            if kid is None or key.get('kid') == kid:
+                try:
+                    return jwt.PyJWK(key)
+                except (ValueError, TypeError) as e:
+                    # Malformed key material gets past PyJWT's own checks as a plain ValueError
+                    raise jwt.PyJWKError(f"Unusable signing key {kid!r}: {e}") from e
+        return None
+
+    def verify_id_token(self, id_token):
+        "Verify the signature, audience, issuer and expiry of an ID token and return its claims. Raises jwt.PyJWTError (jwt.InvalidTokenError, or jwt.PyJWKError for an unusable signing key) and requests.RequestException."
+        header = jwt.get_unverified_header(id_token)
+        key = self.signing_key(header.get('kid'))
+
+        # Only accept the asymmetric algorithms the provider advertises, never 'none' or HMAC
+        algorithms = [
+            alg for alg in self.config().get('id_token_signing_alg_values_supported', ['RS256'])
+            if alg[:2] in ('RS', 'ES', 'PS')
+        ]
+        claims = jwt.decode(
+            id_token,
+            key=key.key,
+            algorithms=algorithms,
+            audience=self.client_id,
+            options={'require': ['iss', 'sub', 'aud', 'exp']},
+        )
+
+        # Google issues tokens both with and without the https:// scheme
+        issuer = self.config().get('issuer', '')
+        if claims['iss'] not in (issuer, issuer.replace('https://', '', 1)):
+            raise jwt.InvalidIssuerError("Invalid issuer")
+        return claims
+
+    def userinfo(self, client, timeout=REQUEST_TIMEOUT):
+        "Fetch the user's claims from the userinfo endpoint, for token responses that carry no ID token."
+        uri, headers, body = client.add_token(self.config()['userinfo_endpoint'])
+        with metrics.track_http(uri):
+            response = requests.get(uri, headers=headers, data=body, timeout=timeout)
+        return response.json()
+
+
+def parse_token_response(client, token_response):
+    "Parse the token endpoint response once, load it into the OAuth client and return it as a dict."
+    token = token_response.json()
+    client.parse_request_body_response(json.dumps(token))
+    return token
+
+
+def google():
+    "Return Google's OpenID provider and the OAuth client of the current app, created on first use."
+    extension = current_app.extensions.get('flaskalbum.google')
+    if extension is None:
+        client_id = current_app.config['GOOGLE_CLIENT_ID']
+        extension = (OpenIDProvider(current_app.config['GOOGLE_DISCOVERY_URL'], client_id), WebApplicationClient(client_id))
+        current_app.extensions['flaskalbum.google'] = extension
+    return extension
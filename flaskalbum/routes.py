@@ -1,24 +1,49 @@
+import hashlib
+import hmac
 import os
 import uuid
-from flask import json, render_template, flash, redirect, request, send_from_directory, url_for, current_app
+from flask import Blueprint, abort, g, jsonify, make_response, render_template, flash, redirect, request, send_file, send_from_directory, session, stream_with_context, url_for, current_app
 from flask_login import current_user, login_required, login_user, logout_user
 import requests
-from flaskalbum.models import Photo, User
+from flaskalbum.models import AlbumStats, Photo, User
 from flaskalbum.utils import send_reset_email
-from flaskalbum import app, db, client
+from flaskalbum.fragments import photo_card, templates_fingerprint
+from flaskalbum.hashing import HasherBusy
+from flaskalbum.imagehost import ImageHostError
+from flaskalbum.mail import outbox
+from flaskalbum.export import export_filename, export_ndjson, export_zip
+from flaskalbum.metrics import metrics, sample
+from flaskalbum.imageproxy import ImageFetchError, get_image_cache, proxy_srcset, proxy_url, verified_url
+from flaskalbum.storage import LocalStorage, get_storage
+from flaskalbum.uploads import enqueue_upload, expire_if_stale, file_size, get_upload_queue, set_status, stage, staging_path, upload_batch
+from flaskalbum.search import get_search_backend, index_photo
+from flaskalbum.oauth import google, parse_token_response
+from flaskalbum.throttle import login_limiters
+from flaskalbum import db
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import LimitedStream
+import jwt
+from oauthlib.oauth2 import OAuth2Error
 
-GOOGLE_DISCOVERY_URL = os.getenv('GOOGLE_DISCOVERY_URL')
 GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
 GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
 
+main = Blueprint('main', __name__)
+
+# Room for the other form fields and the multipart framing next to an uploaded photo
+FORM_FIELDS_SIZE = 64 * 1024
+main.add_app_template_global(photo_card)
+main.add_app_template_filter(proxy_url, 'proxied')
+main.add_app_template_filter(proxy_srcset, 'proxied_srcset')
+
 # Route for the home page (login page)
-@app.route('/')
+@main.route('/')
 def index(): 
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
 # Route for user registration
-@app.route('/register', methods=['GET', 'POST'])
+@main.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         # Retrieve user registration form data
@@ -31,48 +56,57 @@ def register():
         }
         
         # display message whether register is success or failed
-        if User.register(data) == 1:
+        result = User.register(data)
+        if result == 1:
             message = 'Account created successfully!'
             flash(message, 'success')
-            return redirect(url_for('login'))
-        elif User.register(data) == -1:
+            return redirect(url_for('main.login'))
+        elif result == -1:
             message = 'Username already exists. Please choose a different one.'
-            flash(message, 'danger')
-            return redirect(url_for('register'))
-        elif User.register(data) == -2:
+        elif result == -2:
             message = 'Email already exists. Please choose a different one.'
-            flash(message, 'danger')
-            return redirect(url_for('register'))
-        elif User.register(data) == 0:
+        else:
             message = 'Account creation failed. Please try again.'
-            flash(message, 'danger')
-            return redirect(url_for('register'))
+        flash(message, 'danger')
+        return redirect(url_for('main.register'))
 
     # Render the registration form for GET requests
     return render_template('register.html', title='Create Account')
 
 # Route for user login
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
 
     if request.method == 'POST':
         if 'login' in request.form:    
             username = request.form['username']
             password = request.form['password']
 
+            # Throttled per account and per client IP, before any hash. An existing account
+            # has one budget whether it is named by its username or its email.
+            login_account_limiter, login_ip_limiter = login_limiters()
+            user = User.find_for_login(username)
+            account = f"id:{user.id}" if user else username.strip().lower()
+            if not (login_ip_limiter.hit(request.remote_addr) and login_account_limiter.hit(account)):
+                flash('Too many login attempts. Please try again later.', 'danger')
+                retry_after = max(login_ip_limiter.retry_after(request.remote_addr), login_account_limiter.retry_after(account))
+                return render_template('login.html', title='Login'), 429, {'Retry-After': str(retry_after)}
+
             # Check if user exists and password is correct
-            authenticated_user = User.authenticate_user(username, password)
+            authenticated_user = User.authenticate(user, password)
             if authenticated_user:             
+                login_account_limiter.reset(account)
                 login_user(authenticated_user)
-                return redirect(url_for('home'))
+                return redirect(url_for('main.home'))
             else:
                 flash('Login unsuccessful. Please check username and password', 'danger')
         
         if 'oauth' in request.form:
             # Find the Google provider configuration
-            google_provider_cfg = requests.get(GOOGLE_DISCOVERY_URL).json()
+            provider, client = google()
+            google_provider_cfg = provider.config()
             authorization_endpoint = google_provider_cfg["authorization_endpoint"]
 
             callback_url = f"{os.environ.get('WEBSITE_DOMAIN')}/login/callback"
@@ -86,123 +120,194 @@ def login():
     
     return render_template('login.html', title='Login')
 
-@app.route("/login/callback")
+@main.route("/login/callback")
 def callback():
     # Get authorization code Google sent back to you
     code = request.args.get("code")
 
     callback_url = f"{os.environ.get('WEBSITE_DOMAIN')}/login/callback"
-    google_provider_cfg = requests.get(GOOGLE_DISCOVERY_URL).json()
-    token_endpoint = google_provider_cfg["token_endpoint"]
-    # Prepare and send a request to get tokens! Yay tokens!
-    token_url, headers, body = client.prepare_token_request(
-        token_endpoint,
-        authorization_response=request.url,
-        redirect_url=callback_url,
-        code=code
-    )
-    token_response = requests.post(
-        token_url,
-        headers=headers,
-        data=body,
-        auth=(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET),
-    )
-
-    # Parse the tokens!
-    client.parse_request_body_response(json.dumps(token_response.json())) 
-
-    userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
-    uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
-
-    if userinfo_response.json().get("email_verified"):
-        id = userinfo_response.json()["sub"]
-        email = userinfo_response.json()["email"]
-        profile_photo = userinfo_response.json()["picture"]
-        name = userinfo_response.json()["name"]
+    provider, client = google()
+    try:
+        google_provider_cfg = provider.config()
+        token_endpoint = google_provider_cfg["token_endpoint"]
+        # Prepare and send a request to get tokens! Yay tokens!
+        token_url, headers, body = client.prepare_token_request(
+            token_endpoint,
+            authorization_response=request.url,
+            redirect_url=callback_url,
+            code=code
+        )
+        with metrics.track_http(token_url):
+            token_response = requests.post(
+                token_url,
+                headers=headers,
+                data=body,
+                auth=(GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET),
+                timeout=10,
+            )
+
+        # Parse the tokens!
+        token = parse_token_response(client, token_response)
 
+        # The ID token already carries the user's profile, verify it locally instead of calling userinfo
+        if 'id_token' in token:
+            userinfo = provider.verify_id_token(token['id_token'])
+        else:
+            userinfo = provider.userinfo(client)
+    except (jwt.PyJWTError, requests.RequestException, OAuth2Error) as e:
+        # A rejected token, an unusable signing key, Google unreachable or the code refused
+        current_app.logger.warning(f"Google sign-in failed: {e}")
+        flash('Google sign-in failed. Please try again.', 'danger')
+        return redirect(url_for('main.login'))
+
+    if userinfo.get("email_verified"):
         data = {
-            'id': id,
-            'name': name,
-            'email': email,
-            'profile_photo': profile_photo
+            'id': userinfo["sub"],
+            'name': userinfo.get("name"),
+            'email': userinfo["email"],
+            'profile_photo': userinfo.get("picture")
         }
 
         user = User.oauth(data)
         
         login_user(user)
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
         
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
+
+def album_etag(version):
+    "Strong ETag for a page of the current user's album. It changes with the album version, the user's name and profile photo (shown in the layout), the templates and the request URL."
+    parts = (version, current_user.id, current_user.name, current_user.profile_photo, templates_fingerprint(), request.full_path)
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def with_etag(response, etag):
+    "Attach the ETag, unless the response carries flashed messages: a later 304 would show them again."
+    if etag is not None:
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+
+def cached_album_page(version):
+    "Return (etag, whether the client's copy is current). Without an etag when messages are waiting to be flashed, they must be rendered."
+    if '_flashes' in session:
+        return None, False
+    etag = album_etag(version)
+    return etag, request.if_none_match.contains(etag)
 
-@app.route('/home')
+
+@main.route('/home')
 @login_required
 def home():
-    photo_details = Photo.query.filter_by(user_id=current_user.id).all()
-    
-    # Create a list of photo objects with both details and URLs
-    photos = []
-    for photo in photo_details:
-        if photo.filename:
-            photo_data = {
-                'id': photo.id,
-                'url': photo.image_url,
-                'title': photo.title,
-                'description': photo.description,
-                'location': photo.location,
-                'tags': photo.tags,
-                'upload_date': photo.upload_date,
-                'is_favorite': photo.is_favorite
-            }
-            photos.append(photo_data)
+    # Repeat visits to an unchanged album cost one version lookup
+    version = AlbumStats.version_of(current_user.id)
+    etag, not_modified = cached_album_page(version)
+    if not_modified:
+        return with_etag(current_app.response_class(status=304), etag)
+
+    # Only the first page is rendered, the rest is fetched from /api/photos while scrolling
+    tags = request.args.getlist('tag')
+    photos, next_cursor = Photo.page_for_user(current_user.id, tags=tags)
+    photos = [photo.to_dict() for photo in photos]
+    stats = AlbumStats.get(current_user.id)
+
+    response = make_response(render_template('home.html', title='Home', name=current_user.name, photos=photos, next_cursor=next_cursor, tags=tags, stats=stats, version=version))
+    return with_etag(response, etag)
+
+# Route for the counts and most used tags and locations of the user's album
+@main.route('/api/stats')
+@login_required
+def api_stats():
+    return jsonify(AlbumStats.get(current_user.id).to_dict(limit=request.args.get('limit', 10, type=int)))
 
-    if request.method == 'POST':
-        if 'edit_details' in request.form:
-            return url_for('edit_photo', photo_id=photo.id)
-    
-    return render_template('home.html', title='Home', name=current_user.name, photos=photos)
+# Route for the gallery's infinite scroll, returns one page of photos after the given cursor.
+# Repeating ?tag= narrows the page down to photos carrying all of the given tags.
+@main.route('/api/photos')
+@login_required
+def api_photos():
+    version = AlbumStats.version_of(current_user.id)
+    etag, not_modified = cached_album_page(version)
+    if not_modified:
+        return with_etag(current_app.response_class(status=304), etag)
 
-@app.route('/contact')
+    try:
+        photos, next_cursor = Photo.page_for_user(
+            current_user.id,
+            cursor=request.args.get('cursor'),
+            tags=request.args.getlist('tag')
+        )
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor.'}), 400
+
+    photos = [photo.to_dict() for photo in photos]
+    response = jsonify({
+        'photos': [dict(photo, upload_date=photo['upload_date'].isoformat()) for photo in photos],
+        'html': render_template('partials/photo_cards.html', photos=photos, version=version),
+        'next_cursor': next_cursor
+    })
+    return with_etag(response, etag)
+
+# Route for searching the title, description and location of the user's photos, best match first
+@main.route('/search')
+@login_required
+def search():
+    query = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        abort(404)
+
+    version = AlbumStats.version_of(current_user.id)
+    photos, has_next = get_search_backend().search(current_user.id, query, page=page) if query else ([], False)
+    photos = [photo.to_dict() for photo in photos]
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            'photos': [dict(photo, upload_date=photo['upload_date'].isoformat()) for photo in photos],
+            'page': page,
+            'has_next': has_next
+        })
+    return render_template('search.html', title='Search', query=query, photos=photos, page=page, has_next=has_next, version=version)
+
+@main.route('/contact')
 def contact():
     return render_template('contact.html', title='Contact')
 
-@app.context_processor
+@main.app_context_processor
 def profile_display():
     if current_user.is_authenticated:
-        # 
-        if current_user.password != None: # user is not oauth user
-            profile_photo = (current_user.profile_photo) if current_user.profile_photo else None
-        else: # user is oauth user
-            profile_photo = current_user.profile_photo
+        # Same for password and OAuth users, and reads only columns kept in the user cache
+        profile_photo = current_user.profile_photo if current_user.profile_photo else None
         return dict(profile_photo=profile_photo)
     return {}
 
-@app.route('/profile', methods=['GET', 'POST'])
+@main.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
     user = User.query.filter_by(email=current_user.email).first()
 
     if request.method == 'POST':
+        # Before request.files makes Werkzeug read the body
+        limit_photo_request()
+
         if 'profile_photo' in request.files:
             profile_photo = request.files['profile_photo']
+            if file_size(profile_photo.stream) > current_app.config['MAX_PHOTO_SIZE']:
+                abort(413)
             if profile_photo.filename:
-                unique_filename = secure_filename(f"{current_user.id}_{profile_photo.filename}")
-                api_url = "https://freeimage.host/api/1/upload"
-                api_key = os.environ.get('IMG_API_KEY')
-                files = {'source': (unique_filename, profile_photo.read())}
-                data = {'key': api_key, 'action': 'upload'}
-                response = requests.post(api_url, files=files, data=data)
-                response_data = response.json()
-                if response.status_code == 200 and response_data.get('status_code') == 200:
-                    user.profile_photo = response_data['image']['url']
+                unique_filename = secure_filename(f"profile_{uuid.uuid4().hex}_{current_user.id}_{profile_photo.filename}")
+                try:
+                    user.profile_photo = get_storage().save(unique_filename, profile_photo.stream)
                     db.session.commit()
+                    User.invalidate_cache(user.id)
                     flash('Profile photo updated successfully!', 'success')
-                else:
+                except (ImageHostError, OSError) as e:
                     flash('Failed to upload profile photo.', 'error')
-                    current_app.logger.error(f"FreeImageHost upload failed: {response_data}")
+                    current_app.logger.error(f"Profile photo upload failed: {e}")
             else:
                 flash('No file selected', 'error')
-            return redirect(url_for('profile'))
+            return redirect(url_for('main.profile'))
 
         if 'update_profile' in request.form:
             update_username = request.form['username']
@@ -214,7 +319,7 @@ def profile():
                 current_user.username = update_username
             else:
                 flash("Failed to update information.", 'danger')
-            return redirect(url_for('profile'))
+            return redirect(url_for('main.profile'))
 
         if 'delete_acc' in request.form:
             delete_account = User.delete_account(current_user.username)
@@ -228,19 +333,19 @@ def profile():
     return render_template('profile.html', title='Profile', username=current_user.username, email=user.email, name=user.name, profile_photo=user.profile_photo)
 
 # Route for user logout
-@app.route('/logout')
+@main.route('/logout')
 def logout():
     # Remove the username from the session and redirect to the home page
     logout_user()
     return redirect('/')
 
-@app.route("/reset_password", methods=['GET', 'POST'])
+@main.route("/reset_password", methods=['GET', 'POST'])
 def reset_request():
     if request.method == 'POST':
         email = request.form.get('email')
         if not email:
             flash('Email is required.', 'error')
-            return redirect(url_for('reset_request'))
+            return redirect(url_for('main.reset_request'))
             
         user = User.query.filter_by(email=email).first()
         flash('If an account exists with that email, you will receive password reset instructions.', 'info')
@@ -248,11 +353,11 @@ def reset_request():
             try:
                 send_reset_email(user)
             except Exception as e:
-                print(e)
-        return redirect(url_for('login'))
+                current_app.logger.error(f"Could not queue password reset email: {e}")
+        return redirect(url_for('main.login'))
     return render_template('reset_request.html', title='Reset Password')
 
-@app.route("/reset_password/<token>", methods=['GET', 'POST'])
+@main.route("/reset_password/<token>", methods=['GET', 'POST'])
 def reset_token(token):
     # Verify the reset token
     email_from_token = User.verify_reset_token(token)
@@ -282,106 +387,308 @@ def reset_token(token):
     # Render the password reset form for GET requests
     return render_template('reset_token.html', title='Reset Password')
 
-@app.errorhandler(404)
+@main.app_errorhandler(404)
 def not_found_error(error):
     return render_template('errors/404.html'), 404
 
+# Route serving photos kept by the local storage backend. Keys never change content,
+# so responses carry an ETag and Last-Modified, answer conditional and Range requests
+# and may be cached for a long time.
+@main.route('/media/<key>')
+def media(key):
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        abort(404)
+    try:
+        directory, filename = os.path.split(storage.path(key))
+    except ValueError:
+        abort(404)
+
+    response = send_from_directory(directory, filename, max_age=current_app.config['MEDIA_MAX_AGE'], conditional=True, etag=True)
+    response.cache_control.immutable = True
+    return response
+
+# Route serving remote images from the local cache, see imageproxy.proxy_url. Cached
+# copies never change, so they may be cached by browsers for a long time.
+@main.route('/img/<signature>/<token>')
+def image_proxy(signature, token):
+    url = verified_url(signature, token)
+    if url is None:
+        abort(404)
+    try:
+        path, content_type = get_image_cache().get(url)
+    except ImageFetchError as e:
+        current_app.logger.warning(f"Image proxy: {e}")
+        abort(502)
+
+    response = send_file(path, mimetype=content_type, max_age=current_app.config['IMAGE_PROXY_MAX_AGE'], conditional=True, etag=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    # Remote content on our origin: never sniffed into another type, never allowed to run anything
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Content-Security-Policy'] = "default-src 'none'"
+    return response
+
+# Route downloading the signed-in user's album, as NDJSON metadata or a ZIP of the photos
+# and their metadata. The body is produced while it is sent, never held in memory whole.
+@main.route('/export/<any(ndjson, zip):format>')
+@login_required
+def export_album(format):
+    if format == 'zip':
+        chunks, mimetype = export_zip(current_user.id), 'application/zip'
+    else:
+        chunks, mimetype = export_ndjson(current_user.id), 'application/x-ndjson'
+    response = current_app.response_class(stream_with_context(chunks), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{export_filename(current_user, format)}"'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# Prometheus scrape endpoint. With METRICS_TOKEN set, scrapers must send it as a bearer token.
+@main.route('/metrics')
+def metrics_endpoint():
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        abort(404)
+
+    attempts = {}
+    for limiter in login_limiters():
+        stats = limiter.stats()
+        attempts[(limiter.name, 'allowed')] = stats['allowed']
+        attempts[(limiter.name, 'rejected')] = stats['rejected']
+    lines = metrics.render()
+    lines += sample('flaskalbum_login_attempts_total', 'Login attempts let through or rejected, by rate limiter.', 'counter', attempts, ('limiter', 'outcome'))
+    lines += sample('flaskalbum_emails_total', 'Emails sent, and given up on after retries.', 'counter', {('sent',): outbox.sent, ('failed',): outbox.failed}, ('outcome',))
+    lines += sample('flaskalbum_email_queue', 'Emails waiting to be sent.', 'gauge', {(): outbox.qsize()})
+    lines += sample('flaskalbum_upload_queue', 'Uploads waiting for the image host.', 'gauge', {(): get_upload_queue().qsize()})
+    return current_app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# Raised when the password hashing pool is saturated, e.g. during a login spike
+@main.app_errorhandler(HasherBusy)
+def hasher_busy(error):
+    current_app.logger.warning(f"Password hashing pool busy on {request.path}")
+    flash('The server is busy right now. Please try again in a moment.', 'warning')
+    return redirect(request.path)
+
+def photo_too_large_message():
+    return f"Photos can be at most {current_app.config['MAX_PHOTO_SIZE'] // (1024 * 1024)} MB."
+
+def limit_photo_request():
+    "Stop reading the body of a single photo upload with a 413 once it is larger than a photo and its form fields. A chunked request declares no size to check up front, and Werkzeug would read it up to MAX_CONTENT_LENGTH."
+    g.photo_request = True
+    limit = current_app.config['MAX_PHOTO_SIZE'] + FORM_FIELDS_SIZE
+    if request.content_length and request.content_length > limit:
+        abort(413)
+    # Wraps the body before request.files first reads it
+    request.environ['wsgi.input'] = LimitedStream(request.environ['wsgi.input'], limit, is_max=True)
+
+# Raised by Werkzeug when a request body is larger than MAX_CONTENT_LENGTH (or a single
+# photo upload is larger than MAX_PHOTO_SIZE)
+@main.app_errorhandler(413)
+def request_too_large(error):
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': 'Request too large.'}), 413
+    if g.get('photo_request'):
+        flash(photo_too_large_message(), 'error')
+        return redirect(url_for('main.profile' if request.endpoint == 'main.profile' else 'main.home'))
+    flash(f"Upload too large, at most {current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} MB per request.", 'error')
+    return redirect(url_for('main.home'))
+
 # ========================================================================================================
 
-@app.route('/upload_photo', methods=['POST'])
+@main.route('/upload_photo', methods=['POST'])
 @login_required
 def upload_photo():
+    # Before request.files makes Werkzeug read the body
+    limit_photo_request()
+
     if 'photo' not in request.files:
         flash('No file part in the request.', 'error')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
 
     photo = request.files['photo']
     if photo.filename == '':
         flash('No selected file.', 'error')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
+
+    # Refuse early rather than writing a file the workers cannot pick up
+    if get_upload_queue().full():
+        flash('Too many uploads in progress. Please try again in a moment.', 'error')
+        return redirect(url_for('main.home'))
 
     try:
         # Generate a unique filename
         unique_filename = secure_filename(f"{current_user.id}_{photo.filename}")
-        
-        # Use FreeImageHost API to upload the photo
-        api_url = "https://freeimage.host/api/1/upload"
-        api_key = os.environ.get('IMG_API_KEY')  # Replace with your FreeImageHost API key
-        
-        files = {
-            'source': (unique_filename, photo.read()),
-        }
-        data = {
-            'key': api_key,
-            'action': 'upload',
-        }
-
-        response = requests.post(api_url, files=files, data=data)
-        response_data = response.json()
-
-        if response.status_code == 200 and response_data.get('status_code') == 200:
-            # Extract image URL from the response
-            image_url = response_data['image']['url']
-            
-            # Save photo details to the database
-            new_photo = Photo(
-                id=uuid.uuid4().hex,
-                filename=unique_filename,  # Store the unique filename
-                title=request.form['title'],
-                description=request.form['description'],
-                location=request.form['location'],
-                tags=request.form['tags'],
-                user_id=current_user.id,
-                image_url=image_url  # Store the uploaded image URL
-            )
-
-            db.session.add(new_photo)
-            db.session.commit()
-            flash('Photo uploaded successfully!', 'success')
+        photo_id = uuid.uuid4().hex
+
+        # Keep the file on disk, a background worker pushes it to the image host
+        path = staging_path(photo_id, unique_filename)
+        stage(photo.stream, path, current_app.config['MAX_PHOTO_SIZE'])
+
+        # Save photo details to the database, the image URL is filled in once the upload is done
+        AlbumStats.lock(current_user.id)
+        new_photo = Photo(
+            id=photo_id,
+            filename=unique_filename,  # Store the unique filename
+            title=request.form['title'],
+            description=request.form['description'],
+            location=request.form['location'],
+            tags=request.form['tags'],
+            user_id=current_user.id,
+            status=Photo.STATUS_PENDING
+        )
+        new_photo.sync_tags()
+        AlbumStats.record(current_user.id, added=[new_photo.stats_entry()])
+
+        db.session.add(new_photo)
+        db.session.commit()
+        index_photo(new_photo)
+
+        if enqueue_upload(photo_id, path):
+            flash('Photo uploaded! It will appear in your album in a moment.', 'success')
         else:
-            flash('Failed to upload photo to FreeImageHost.', 'error')
+            set_status(new_photo, Photo.STATUS_FAILED)
+            db.session.commit()
+            os.remove(path)
+            flash('Too many uploads in progress. Please try again in a moment.', 'error')
             
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         db.session.rollback()
         flash('Error uploading photo.', 'error')
-        print(e)  # For debugging
+        current_app.logger.error(f"Error uploading photo: {e}")
+
+    return redirect(url_for('main.home'))
+
+# Route for uploading many photos at once. The title, description, location and tags
+# fields may be repeated once per file, or given once to apply to every file.
+@main.route('/upload_photos', methods=['POST'])
+@login_required
+def upload_photos():
+    files = request.files.getlist('photos')
+    wants_json = request.accept_mimetypes.best == 'application/json'
+
+    error = None
+    if not files:
+        error = 'No files in the request.'
+    elif len(files) > current_app.config['UPLOAD_BATCH_MAX_FILES']:
+        error = f"At most {current_app.config['UPLOAD_BATCH_MAX_FILES']} photos can be uploaded at once."
+    if error:
+        if wants_json:
+            return jsonify({'error': error}), 400
+        flash(error, 'error')
+        return redirect(url_for('main.home'))
+
+    details = []
+    fields = {field: request.form.getlist(field) for field in ('title', 'description', 'location', 'tags')}
+    for i in range(len(files)):
+        info = {}
+        for field, values in fields.items():
+            if len(values) == len(files):
+                info[field] = values[i]
+            else:
+                info[field] = values[0] if len(values) == 1 else ''
+        details.append(info)
+
+    results = upload_batch(current_user.id, files, details)
+    uploaded = sum(1 for result in results if result['status'] == 'uploaded')
 
-    return redirect(url_for('home'))
+    if wants_json:
+        return jsonify({'uploaded': uploaded, 'failed': len(results) - uploaded, 'results': results})
 
-@app.route('/photo/<photo_id>/delete', methods=['POST'])
+    if uploaded:
+        flash(f'{uploaded} of {len(results)} photos uploaded successfully!', 'success')
+    if uploaded < len(results):
+        failed = ', '.join(result['filename'] for result in results if result['status'] != 'uploaded')
+        flash(f'Failed to upload: {failed}', 'error')
+    return redirect(url_for('main.home'))
+
+# Route polled by the gallery while a photo is still being uploaded to the image host
+@main.route('/api/photos/<photo_id>/status')
+@login_required
+def photo_status(photo_id):
+    photo = Photo.query.filter_by(id=photo_id, user_id=current_user.id).first_or_404()
+    if expire_if_stale(photo):
+        db.session.commit()
+    # The gallery shows these as they are, so they go through the image proxy like the rendered cards
+    return jsonify({
+        'id': photo.id,
+        'status': photo.status,
+        'url': proxy_url(photo.image_url),
+        'thumbnail_url': proxy_url(photo.thumbnail_url),
+        'srcset': proxy_srcset(photo.srcset)
+    })
+
+@main.route('/photo/<photo_id>/delete', methods=['POST'])
 @login_required
 def delete_photo(photo_id):
     photo = Photo.query.get_or_404(photo_id)
     if photo.user_id != current_user.id:
         flash('Unauthorized access')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     
-    # Delete database record
-    db.session.delete(photo)
-    db.session.commit()
+    Photo.delete_many([photo.id])
     flash('Photo deleted successfully!', 'success')
-    return redirect(url_for('home'))
+    return redirect(url_for('main.home'))
 
-@app.route('/photo/<photo_id>/edit', methods=['GET', 'POST'])
+@main.route('/photo/<photo_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_photo(photo_id):
     photo = Photo.query.get_or_404(photo_id)
     if photo.user_id != current_user.id:
         flash('Unauthorized access', 'danger')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
     if request.method == 'POST':
+        AlbumStats.lock(photo.user_id)
+        before = photo.stats_entry()
         photo.title = request.form['title']
         photo.description = request.form['description']
         photo.location = request.form['location']
         photo.tags = request.form['tags']
         
         try:
+            photo.sync_tags()
+            AlbumStats.record(photo.user_id, added=[photo.stats_entry()], removed=[before])
             db.session.commit()
+            index_photo(photo)
             flash('Photo details updated successfully!', 'success')
         except Exception as e:
             db.session.rollback()
             flash('Error updating photo details.', 'error')
             current_app.logger.error(f"Error updating photo details: {str(e)}")
         
-        return redirect(url_for('home'))
-    return render_template('edit_photo.html', title='Edit Photo', photo=photo)
\ No newline at end of file
+        return redirect(url_for('main.home'))
+    return render_template('edit_photo.html', title='Edit Photo', photo=photo)
+
+# JSON API applying one action to many of the user's photos at once:
+# {"action": "add_tags", "ids": [...], "tags": "beach, sunset"}. Ids of other users' photos are ignored.
+@main.route('/api/photos/bulk', methods=['POST'])
+@login_required
+def bulk_photos():
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    ids = data.get('ids')
+    if action not in Photo.BULK_ACTIONS:
+        return jsonify({'error': f"action must be one of: {', '.join(Photo.BULK_ACTIONS)}."}), 400
+    if not isinstance(ids, list) or not ids or not all(isinstance(photo_id, str) for photo_id in ids):
+        return jsonify({'error': 'ids must be a non-empty list of photo ids.'}), 400
+    if len(ids) > current_app.config['BULK_MAX_PHOTOS']:
+        return jsonify({'error': f"At most {current_app.config['BULK_MAX_PHOTOS']} photos per request."}), 400
+
+    value = None
+    if action in ('add_tags', 'remove_tags'):
+        value = data.get('tags')
+        if not isinstance(value, str) or not value.strip():
+            return jsonify({'error': 'tags is required.'}), 400
+    elif action == 'set_location':
+        value = data.get('location')
+        if not isinstance(value, str) or len(value.strip()) > Photo.location.type.length:
+            return jsonify({'error': f"location must be a string of at most {Photo.location.type.length} characters."}), 400
+
+    ids = list(dict.fromkeys(ids))
+    try:
+        affected = Photo.bulk_edit(current_user.id, ids, action, value)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'action': action, 'requested': len(ids), 'affected': affected})
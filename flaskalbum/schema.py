@@ -0,0 +1,27 @@
+from sqlalchemy.schema import CreateColumn
+from flaskalbum import db
+
+
+# db.create_all() only creates missing tables, so indexes added to a model
+# later never reach a database that already has the table. Create them here.
+def create_missing_indexes():
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+
+# Same for columns: add the ones a model gained after its table was created.
+# New columns must be nullable or have a server_default so existing rows stay valid.
+def add_missing_columns():
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(db.text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column_ddl}"))
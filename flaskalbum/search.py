@@ -0,0 +1,160 @@
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from flask import current_app
+from sqlalchemy.dialects.mysql import match
+from flaskalbum import db
+from flaskalbum.models import Photo
+
+# Results per search page
+RESULTS_PER_PAGE = 24
+
+
+def tokenize(text):
+    "Lowercased words of at least two characters."
+    return [token for token in re.findall(r'\w+', (text or '').lower()) if len(token) > 1]
+
+
+class SearchBackend:
+    "Ranked search over the title, description and location of one user's photos."
+
+    def search(self, user_id, query, page=1, per_page=RESULTS_PER_PAGE):
+        "Return (photos of the requested page, best match first, whether there is a next page)."
+        raise NotImplementedError
+
+    def index_photo(self, photo_id, user_id, title, description, location):
+        "Called after a photo was created or edited."
+        pass
+
+    def remove_photos(self, user_id, photo_ids):
+        "Called after photos were deleted."
+        pass
+
+    def remove_user(self, user_id):
+        "Called after a user and all their photos were deleted."
+        pass
+
+
+class FulltextSearch(SearchBackend):
+    "MySQL FULLTEXT index on (title, description, location), kept up to date by MySQL itself."
+
+    def search(self, user_id, query, page=1, per_page=RESULTS_PER_PAGE):
+        score = match(Photo.title, Photo.description, Photo.location, against=query).in_natural_language_mode()
+        rows = (
+            db.session.query(Photo, score.label('score'))
+            .filter(Photo.user_id == user_id, score > 0)
+            .order_by(db.desc('score'), Photo.id)
+            .offset((page - 1) * per_page)
+            .limit(per_page + 1)
+            .all()
+        )
+        photos = [photo for photo, _ in rows]
+        return photos[:per_page], len(photos) > per_page
+
+
+class InvertedIndexSearch(SearchBackend):
+    "In-process inverted index, used where there is no FULLTEXT support (SQLite in tests and development). A user's index is built from the database on their first search and then updated by index_photo/remove_photos. Each process keeps its own copy, so this is not meant for multi-worker deployments."
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user id -> token -> photo id -> term frequency
+        self._postings = {}
+        # user id -> photo id -> its tokens, to undo a photo's postings on edit or delete
+        self._documents = {}
+
+    def search(self, user_id, query, page=1, per_page=RESULTS_PER_PAGE):
+        tokens = set(tokenize(query))
+        if not tokens:
+            return [], False
+        self._ensure_built(user_id)
+
+        with self._lock:
+            postings = self._postings[user_id]
+            document_count = len(self._documents[user_id]) or 1
+            scores = Counter()
+            for token in tokens:
+                matches = postings.get(token, {})
+                if not matches:
+                    continue
+                # tf-idf: rarer words weigh more
+                idf = math.log(1 + document_count / len(matches))
+                for photo_id, frequency in matches.items():
+                    scores[photo_id] += frequency * idf
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        page_ids = [photo_id for photo_id, _ in ranked[(page - 1) * per_page:page * per_page]]
+        photos = {photo.id: photo for photo in Photo.query.filter(Photo.id.in_(page_ids)).all()} if page_ids else {}
+        return [photos[photo_id] for photo_id in page_ids if photo_id in photos], len(ranked) > page * per_page
+
+    def index_photo(self, photo_id, user_id, title, description, location):
+        with self._lock:
+            if user_id not in self._postings:
+                # Not built yet, the first search reads the photo from the database
+                return
+            self._remove(user_id, photo_id)
+            self._add(user_id, photo_id, tokenize(' '.join(filter(None, (title, description, location)))))
+
+    def remove_photos(self, user_id, photo_ids):
+        with self._lock:
+            if user_id in self._postings:
+                for photo_id in photo_ids:
+                    self._remove(user_id, photo_id)
+
+    def remove_user(self, user_id):
+        with self._lock:
+            self._postings.pop(user_id, None)
+            self._documents.pop(user_id, None)
+
+    def _ensure_built(self, user_id):
+        with self._lock:
+            if user_id in self._postings:
+                return
+
+        postings = defaultdict(dict)
+        documents = {}
+        rows = (
+            db.session.query(Photo.id, Photo.title, Photo.description, Photo.location)
+            .filter(Photo.user_id == user_id)
+            .yield_per(1000)
+        )
+        for photo_id, title, description, location in rows:
+            tokens = tokenize(' '.join(filter(None, (title, description, location))))
+            documents[photo_id] = tokens
+            for token, frequency in Counter(tokens).items():
+                postings[token][photo_id] = frequency
+
+        with self._lock:
+            if user_id not in self._postings:
+                self._postings[user_id] = postings
+                self._documents[user_id] = documents
+
+    def _add(self, user_id, photo_id, tokens):
+        self._documents[user_id][photo_id] = tokens
+        for token, frequency in Counter(tokens).items():
+            self._postings[user_id].setdefault(token, {})[photo_id] = frequency
+
+    def _remove(self, user_id, photo_id):
+        for token in set(self._documents[user_id].pop(photo_id, ())):
+            matches = self._postings[user_id].get(token)
+            if matches is not None:
+                matches.pop(photo_id, None)
+                if not matches:
+                    del self._postings[user_id][token]
+
+
+def index_photo(photo):
+    "Tell the search backend a photo was created or edited."
+    get_search_backend().index_photo(photo.id, photo.user_id, photo.title, photo.description, photo.location)
+
+
+def get_search_backend():
+    "Return the search backend selected by SEARCH_BACKEND: 'fulltext', 'memory', or 'auto' (fulltext on MySQL, memory elsewhere)."
+    backend = current_app.extensions.get('flaskalbum.search')
+    if backend is None:
+        choice = current_app.config['SEARCH_BACKEND']
+        if choice == 'auto':
+            choice = 'fulltext' if db.engine.dialect.name == 'mysql' else 'memory'
+        backend = FulltextSearch() if choice == 'fulltext' else InvertedIndexSearch()
+        current_app.extensions['flaskalbum.search'] = backend
+    return backend
@@ -0,0 +1,86 @@
+/**
+* Gallery infinite scroll: loads the next page of photos from /api/photos
+* when the sentinel below the grid scrolls into view.
+* Photos still being uploaded are polled until their image is ready.
+*/
+document.addEventListener('DOMContentLoaded', () => {
+  "use strict";
+
+  const grid = document.querySelector('#gallery-grid');
+  const sentinel = document.querySelector('#gallery-sentinel');
+  if (!grid || !sentinel) return;
+
+  const STATUS_POLL_INTERVAL = 3000;
+
+  /**
+   * Poll the status of every pending photo until it is ready or failed
+   */
+  async function pollPendingPhotos() {
+    const pending = grid.querySelectorAll('.gallery-item[data-photo-status="pending"]');
+    for (const item of pending) {
+      const response = await fetch(item.dataset.statusUrl, { credentials: 'same-origin' });
+      if (!response.ok) continue;
+
+      const photo = await response.json();
+      if (photo.status === 'pending') continue;
+
+      item.dataset.photoStatus = photo.status;
+      const label = item.querySelector('.photo-status');
+      if (photo.status === 'ready') {
+        const img = item.querySelector('img');
+        if (photo.srcset) img.srcset = photo.srcset;
+        img.src = photo.thumbnail_url || photo.url;
+        item.querySelector('.preview-link').href = photo.url;
+        if (label) label.remove();
+        if (window.galleryLightbox) window.galleryLightbox.reload();
+      } else if (label) {
+        label.textContent = 'Upload failed';
+      }
+    }
+
+    if (grid.querySelector('.gallery-item[data-photo-status="pending"]')) {
+      setTimeout(pollPendingPhotos, STATUS_POLL_INTERVAL);
+    }
+  }
+
+  let loading = false;
+
+  async function loadNextPage() {
+    const cursor = grid.dataset.nextCursor;
+    if (loading || !cursor) return;
+    loading = true;
+
+    try {
+      const url = new URL(grid.dataset.nextUrl, window.location.href);
+      url.searchParams.set('cursor', cursor);
+      const response = await fetch(url, { credentials: 'same-origin' });
+      if (!response.ok) return;
+
+      const page = await response.json();
+      grid.insertAdjacentHTML('beforeend', page.html);
+      grid.dataset.nextCursor = page.next_cursor || '';
+
+      if (window.galleryLightbox) {
+        window.galleryLightbox.reload();
+      }
+      if (!page.next_cursor) {
+        observer.disconnect();
+      } else {
+        // Re-observe so a sentinel that is still on screen triggers another page
+        observer.unobserve(sentinel);
+        observer.observe(sentinel);
+      }
+    } finally {
+      loading = false;
+    }
+  }
+
+  const observer = new IntersectionObserver(entries => {
+    if (entries.some(entry => entry.isIntersecting)) {
+      loadNextPage();
+    }
+  }, { rootMargin: '600px' });
+
+  observer.observe(sentinel);
+  setTimeout(pollPendingPhotos, STATUS_POLL_INTERVAL);
+});
@@ -101,6 +101,8 @@ document.addEventListener('DOMContentLoaded', () => {
   const glightbox = GLightbox({
     selector: '.glightbox'
   });
+  // Exposed so the gallery can re-bind the lightbox after loading more photos
+  window.galleryLightbox = glightbox;
 
   /**
    * Init swiper slider with 1 slide at once in desktop view
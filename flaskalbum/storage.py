@@ -0,0 +1,117 @@
+import hashlib
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from flask import current_app
+from werkzeug.utils import secure_filename
+from flaskalbum.imagehost import upload_image_with_retries
+from flaskalbum.imageproxy import get_image_cache
+from flaskalbum.jobs import JobQueue
+
+# Removes the files of deleted photos in the background, created on first use
+cleanup_queue = None
+cleanup_queue_lock = threading.Lock()
+
+
+class StorageBackend:
+    "Where photo files are kept. Keys are flat, filename-safe strings such as '<photo id>_<filename>'."
+
+    def save(self, key, fileobj):
+        "Store the contents of a binary file under key and return the URL it is served from."
+        raise NotImplementedError
+
+    def delete(self, key):
+        "Remove the file stored under key, if the backend supports it."
+        raise NotImplementedError
+
+
+class RemoteImageHost(StorageBackend):
+    "Files are pushed to the external image host (freeimage.host or IMAGE_HOST_URL)."
+
+    def save(self, key, fileobj):
+        return upload_image_with_retries(key, fileobj)
+
+    def delete(self, key):
+        # The image host API offers no deletion, remote copies stay where they are
+        pass
+
+
+class LocalStorage(StorageBackend):
+    "Files are kept on local disk under root, spread over two levels of hash-named directories so no single directory grows too large."
+
+    def __init__(self, root, url_prefix='/media'):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def path(self, key):
+        if not key or secure_filename(key) != key:
+            raise ValueError(f"Invalid storage key: {key!r}")
+        shard = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, shard[:2], shard[2:4], key)
+
+    def url(self, key):
+        return f"{self.url_prefix}/{key}"
+
+    def save(self, key, fileobj):
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first so readers never see a half-written image
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(fileobj, out, 1024 * 1024)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return self.url(key)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except (OSError, ValueError):
+            pass
+
+
+def get_storage():
+    "Return the storage backend selected by the STORAGE_BACKEND setting ('remote' or 'local')."
+    storage = current_app.extensions.get('flaskalbum.storage')
+    if storage is None:
+        if current_app.config['STORAGE_BACKEND'] == 'local':
+            storage = LocalStorage(current_app.config['MEDIA_FOLDER'])
+        else:
+            storage = RemoteImageHost()
+        current_app.extensions['flaskalbum.storage'] = storage
+    return storage
+
+
+def get_cleanup_queue():
+    global cleanup_queue
+    with cleanup_queue_lock:
+        if cleanup_queue is None:
+            cleanup_queue = JobQueue('cleanup', workers=1, maxsize=current_app.config['CLEANUP_QUEUE_SIZE'])
+        return cleanup_queue
+
+
+def delete_later(keys, urls=()):
+    "Queue the removal of stored files (by storage key) and of the image proxy's cached copies of remote images (by URL) for a background worker, so deleting photos never waits for the disk. Call once the deletion is committed."
+    app = current_app._get_current_object()
+    try:
+        get_cleanup_queue().submit(_delete_files, app, list(keys), list(urls))
+    except queue.Full:
+        current_app.logger.warning(f"Cleanup queue full, leaving {len(keys)} stored files behind")
+
+
+def _delete_files(app, keys, urls):
+    with app.app_context():
+        storage = get_storage()
+        for key in keys:
+            storage.delete(key)
+        if urls and app.config['IMAGE_PROXY']:
+            cache = get_image_cache()
+            for url in urls:
+                cache.discard(url)
@@ -0,0 +1,148 @@
+import math
+import threading
+import time
+from flask import current_app
+
+
+class MemoryStore:
+    "In-process counter store for SlidingWindowLimiter. A shared store (so all workers see the same counts) only needs the same incr/decr/get/delete methods, with incr and decr atomic."
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def incr(self, key, ttl):
+        "Add one to a counter that expires ttl seconds after it was created, and return the new count."
+        now = time.monotonic()
+        with self._lock:
+            count, expires_at = self._counts.get(key, (0, 0))
+            if expires_at < now:
+                count, expires_at = 0, now + ttl
+            self._counts[key] = (count + 1, expires_at)
+            if len(self._counts) > self.max_keys:
+                self._prune(now)
+            return count + 1
+
+    def decr(self, key):
+        "Take one off a counter, keeping its expiry."
+        with self._lock:
+            count, expires_at = self._counts.get(key, (0, 0))
+            if count > 0:
+                self._counts[key] = (count - 1, expires_at)
+
+    def get(self, key):
+        with self._lock:
+            count, expires_at = self._counts.get(key, (0, 0))
+            return count if expires_at >= time.monotonic() else 0
+
+    def delete(self, key):
+        with self._lock:
+            self._counts.pop(key, None)
+
+    def _prune(self, now):
+        for key in [key for key, (_, expires_at) in self._counts.items() if expires_at < now]:
+            del self._counts[key]
+
+
+class RedisStore:
+    "Counter store shared by every worker, on top of a redis client."
+
+    def __init__(self, client):
+        self.client = client
+
+    def incr(self, key, ttl):
+        pipeline = self.client.pipeline()
+        pipeline.incr(key)
+        pipeline.expire(key, int(ttl), nx=True)
+        return pipeline.execute()[0]
+
+    def decr(self, key):
+        self.client.decr(key)
+
+    def get(self, key):
+        return int(self.client.get(key) or 0)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+
+def counter_store(url):
+    "Counter store for the given CACHE_URL: in-process unless it is a redis:// URL."
+    if url and not url.startswith('memory://'):
+        import redis
+        return RedisStore(redis.Redis.from_url(url))
+    return MemoryStore()
+
+
+class SlidingWindowLimiter:
+    "Sliding window rate limiter: allows at most limit hits per key in any window of seconds. It keeps a counter for the current and the previous fixed window and weighs the previous one by how much of it still overlaps the sliding window, so each key costs two counters instead of a log of timestamps."
+
+    def __init__(self, name, limit, window, store=None):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.store = store or MemoryStore()
+        self.allowed = 0
+        self.rejected = 0
+        self._stats_lock = threading.Lock()
+
+    def _weighted_count(self, key, now):
+        current = math.floor(now / self.window)
+        elapsed = now / self.window - current
+        previous_count = self.store.get(f"{self.name}:{key}:{current - 1}")
+        current_count = self.store.get(f"{self.name}:{key}:{current}")
+        return previous_count * (1 - elapsed) + current_count, current
+
+    def hit(self, key):
+        "Count one attempt for key. Returns False, without counting it, if key is over its budget."
+        now = time.time()
+        current = math.floor(now / self.window)
+        elapsed = now / self.window - current
+        counter = f"{self.name}:{key}:{current}"
+        previous_count = self.store.get(f"{self.name}:{key}:{current - 1}")
+        # Counted first and taken back if over budget: each concurrent attempt gets its own
+        # count from the atomic incr, so a burst cannot all pass before any of it is counted
+        count = self.store.incr(counter, ttl=2 * self.window)
+        allowed = previous_count * (1 - elapsed) + count - 1 < self.limit
+        if not allowed:
+            self.store.decr(counter)
+        with self._stats_lock:
+            if allowed:
+                self.allowed += 1
+            else:
+                self.rejected += 1
+        return allowed
+
+    def retry_after(self, key):
+        "Rough number of seconds until key is under its budget again."
+        now = time.time()
+        count, _ = self._weighted_count(key, now)
+        if count < self.limit:
+            return 0
+        return math.ceil(self.window - (now % self.window))
+
+    def reset(self, key):
+        "Forget the attempts of key, e.g. after a successful login."
+        current = math.floor(time.time() / self.window)
+        for window in (current - 1, current):
+            self.store.delete(f"{self.name}:{key}:{window}")
+
+    def stats(self):
+        "Counters for monitoring."
+        with self._stats_lock:
+            return {'allowed': self.allowed, 'rejected': self.rejected}
+
+
+def login_limiters():
+    "Return the (per account, per client IP) login limiters of the current app, created on first use."
+    limiters = current_app.extensions.get('flaskalbum.login_limiters')
+    if limiters is None:
+        config = current_app.config
+        store = counter_store(config['CACHE_URL'])
+        limiters = (
+            SlidingWindowLimiter('login-account', config['LOGIN_LIMIT_PER_ACCOUNT'], config['LOGIN_LIMIT_WINDOW'], store),
+            SlidingWindowLimiter('login-ip', config['LOGIN_LIMIT_PER_IP'], config['LOGIN_LIMIT_WINDOW'], store),
+        )
+        current_app.extensions['flaskalbum.login_limiters'] = limiters
+    return limiters
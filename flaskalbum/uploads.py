@@ -0,0 +1,283 @@
+import os
+import queue
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import secure_filename
+from flaskalbum import db
+from flaskalbum.derivatives import store_derivatives
+from flaskalbum.imagehost import ImageHostError
+from flaskalbum.jobs import JobQueue
+from flaskalbum.models import AlbumStats, Photo
+from flaskalbum.search import get_search_backend
+from flaskalbum.storage import get_storage
+
+# Photos waiting to be pushed to the image host. Sized from the app config on first use.
+upload_queue = None
+
+
+def get_upload_queue():
+    global upload_queue
+    if upload_queue is None:
+        upload_queue = JobQueue(
+            'upload',
+            workers=current_app.config['UPLOAD_WORKERS'],
+            maxsize=current_app.config['UPLOAD_QUEUE_SIZE'],
+        )
+    return upload_queue
+
+
+def storage_key(photo_id, filename):
+    "Key a photo's file is stored under, unique because it starts with the photo id."
+    return f"{photo_id}_{filename}"
+
+
+def staging_path(photo_id, filename):
+    "Where the incoming bytes of a photo are kept until a worker has uploaded them."
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], storage_key(photo_id, filename))
+
+
+def stage(stream, path, max_bytes):
+    "Copy an uploaded file to its staging path in chunks, counting the bytes actually read rather than trusting a declared size. Raises RequestEntityTooLarge, after removing the partial file, once more than max_bytes were read."
+    size = 0
+    try:
+        with open(path, 'wb') as out:
+            for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise RequestEntityTooLarge()
+                out.write(chunk)
+    except BaseException:
+        _remove(path)
+        raise
+
+
+def enqueue(job, photo_id, path):
+    "Hand a job on a staged photo over to the upload workers. Returns False if the queue is full."
+    app = current_app._get_current_object()
+    try:
+        get_upload_queue().submit(job, app, photo_id, path)
+        return True
+    except queue.Full:
+        return False
+
+
+def enqueue_upload(photo_id, path):
+    "Hand a pending photo over to the upload workers. Returns False if the queue is full."
+    return enqueue(process_upload, photo_id, path)
+
+
+def set_status(photo, status):
+    "Change the status of an upload and bump its album version, so cached gallery pages (and the 304s answered from them) that still show it pending are replaced. Does not commit."
+    photo.status = status
+    AlbumStats.bump(photo.user_id)
+
+
+def process_upload(app, photo_id, path):
+    "Worker job: move a staged photo into the storage backend and mark its row ready (or failed)."
+    with app.app_context():
+        photo = db.session.get(Photo, photo_id)
+        if photo is None or photo.status != Photo.STATUS_PENDING:
+            # Deleted or expired while it was waiting in the queue, or queued twice
+            _remove(path)
+            db.session.remove()
+            return
+
+        try:
+            key = storage_key(photo.id, photo.filename)
+            with open(path, 'rb') as data:
+                photo.image_url = get_storage().save(key, data)
+            photo.storage_key = key
+            status = Photo.STATUS_READY
+        except (ImageHostError, OSError) as e:
+            status = Photo.STATUS_FAILED
+            app.logger.error(f"Upload of photo {photo_id} failed: {e}")
+
+        if status == Photo.STATUS_READY:
+            # Thumbnails are nice to have, the photo is usable without them
+            try:
+                photo.thumbnail_url, photo.srcset = store_derivatives(photo_id, path)
+            except Exception as e:
+                app.logger.warning(f"Could not create thumbnails of photo {photo_id}: {e}")
+
+        try:
+            set_status(photo, status)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Could not save upload result of photo {photo_id}: {e}")
+            # Don't leave it pending, the gallery would poll it forever
+            try:
+                photo = db.session.get(Photo, photo_id)
+                if photo is not None:
+                    set_status(photo, Photo.STATUS_FAILED)
+                    db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"Could not mark photo {photo_id} failed: {e}")
+        finally:
+            db.session.remove()
+            _remove(path)
+
+
+def expire_if_stale(photo):
+    "Mark a photo failed if it has been pending for longer than UPLOAD_PENDING_MAX_AGE, which means its upload job was lost with the worker holding it, and remove its staged file. Returns whether it did. Does not commit."
+    max_age = timedelta(seconds=current_app.config['UPLOAD_PENDING_MAX_AGE'])
+    if photo.status != Photo.STATUS_PENDING or photo.upload_date is None or photo.upload_date > datetime.now() - max_age:
+        return False
+    set_status(photo, Photo.STATUS_FAILED)
+    _remove(staging_path(photo.id, photo.filename))
+    return True
+
+
+def requeue_pending(min_age, batch_size=500):
+    "Queue again the photos left pending for at least min_age (a timedelta) by workers that stopped with their upload jobs still queued. Photos whose staged file is gone are marked failed. Blocks while the upload queue is full. Returns (queued, failed); get_upload_queue().join() waits for the queued ones."
+    cutoff = datetime.now() - min_age
+    upload_queue = get_upload_queue()
+    queued = failed = 0
+    last_id = ''
+    while True:
+        photos = (
+            Photo.query
+            .filter(Photo.status == Photo.STATUS_PENDING, Photo.upload_date <= cutoff, Photo.id > last_id)
+            .order_by(Photo.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not photos:
+            break
+        last_id = photos[-1].id
+        lost = []
+        for photo in photos:
+            path = staging_path(photo.id, photo.filename)
+            if os.path.exists(path):
+                if upload_queue.full():
+                    upload_queue.join()
+                if enqueue_upload(photo.id, path):
+                    queued += 1
+                    continue
+            lost.append(photo)
+        # Albums are locked in user id order, see AlbumStats.lock
+        for photo in sorted(lost, key=lambda photo: photo.user_id):
+            set_status(photo, Photo.STATUS_FAILED)
+            _remove(staging_path(photo.id, photo.filename))
+            failed += 1
+        db.session.commit()
+    return queued, failed
+
+
+def process_derivatives(app, photo_id, path):
+    "Worker job: create the thumbnails of a photo that is already stored."
+    with app.app_context():
+        try:
+            thumbnail_url, srcset = store_derivatives(photo_id, path)
+            photo = db.session.get(Photo, photo_id)
+            if photo is not None:
+                photo.thumbnail_url, photo.srcset = thumbnail_url, srcset
+                AlbumStats.bump(photo.user_id)
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f"Could not create thumbnails of photo {photo_id}: {e}")
+        finally:
+            db.session.remove()
+            _remove(path)
+
+
+def upload_batch(user_id, files, details):
+    "Push many photos to the storage backend concurrently and insert all of them with one bulk INSERT. details holds the title/description/location/tags of each file. Returns one result per file, in order."
+    app = current_app._get_current_object()
+    storage = get_storage()
+
+    def push(key, data):
+        with app.app_context():
+            return storage.save(key, data)
+
+    results = []
+    rows = []
+    with ThreadPoolExecutor(max_workers=app.config['UPLOAD_BATCH_FANOUT']) as pool:
+        # One (photo id, stored filename, future or error message) entry per file
+        transfers = []
+        for photo in files:
+            photo_id = uuid.uuid4().hex
+            filename = secure_filename(f"{user_id}_{photo.filename}")
+            if not photo.filename:
+                transfers.append((photo_id, filename, 'No selected file.'))
+            elif file_size(photo.stream) > app.config['MAX_PHOTO_SIZE']:
+                transfers.append((photo_id, filename, 'File too large.'))
+            else:
+                future = pool.submit(push, storage_key(photo_id, filename), photo.stream)
+                transfers.append((photo_id, filename, future))
+
+        for photo, info, (photo_id, filename, future) in zip(files, details, transfers):
+            if isinstance(future, str):
+                results.append({'filename': photo.filename, 'status': 'failed', 'error': future})
+                continue
+            try:
+                image_url = future.result()
+            except (ImageHostError, OSError) as e:
+                app.logger.error(f"Batch upload of {photo.filename} failed: {e}")
+                results.append({'filename': photo.filename, 'status': 'failed', 'error': 'Upload failed.'})
+                continue
+
+            rows.append(dict(
+                info,
+                id=photo_id,
+                filename=filename,
+                user_id=user_id,
+                image_url=image_url,
+                storage_key=storage_key(photo_id, filename),
+                is_favorite=False,
+                status=Photo.STATUS_READY
+            ))
+            results.append({'filename': photo.filename, 'status': 'uploaded', 'id': photo_id, 'url': image_url})
+
+    if rows:
+        try:
+            # One multi-row INSERT (plus one for their tags) and one commit for the whole batch
+            AlbumStats.lock(user_id)
+            db.session.execute(db.insert(Photo), rows)
+            Photo.index_tags({row['id']: row.get('tags') for row in rows})
+            AlbumStats.record(user_id, added=[AlbumStats.entry(row.get('tags'), row.get('location')) for row in rows])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"Could not save batch of {len(rows)} photos: {e}")
+            for result in results:
+                if result['status'] == 'uploaded':
+                    result.update(status='failed', error='Could not save photo details.')
+                    del result['id'], result['url']
+            return results
+
+        search = get_search_backend()
+        for row in rows:
+            search.index_photo(row['id'], user_id, row.get('title'), row.get('description'), row.get('location'))
+
+        # Thumbnails are made by the background workers from a staged copy of each file
+        uploaded = {result['id'] for result in results if result['status'] == 'uploaded'}
+        for photo, (photo_id, filename, future) in zip(files, transfers):
+            if photo_id not in uploaded or get_upload_queue().full():
+                continue
+            path = staging_path(photo_id, filename)
+            photo.stream.seek(0)
+            photo.save(path)
+            if not enqueue(process_derivatives, photo_id, path):
+                _remove(path)
+
+    return results
+
+
+def file_size(stream):
+    "Size of an uploaded file, found by seeking rather than reading it."
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(0)
+    return size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
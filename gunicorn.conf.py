@@ -0,0 +1,57 @@
+# gunicorn settings for production: gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Every setting can be overridden with an environment variable. Send SIGHUP to the
+# master for a graceful reload of the workers (new config, finishing in-flight
+# requests first). Because the app is preloaded, deploying new code needs a restart
+# or SIGUSR2 (start a new master next to the old one), not SIGHUP.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 80)}"
+
+# Preforked worker processes, each running a pool of threads. Threads suit this app:
+# requests mostly wait on MySQL and the image host, and bcrypt releases the GIL.
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+
+# Import the app once in the master, workers fork with it already loaded
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+# Off by default: a recycled worker drops the jobs still in its in-memory queues (uploads,
+# mail, file cleanup). When set, workers restart after about that many requests, spread
+# out so they do not all restart at once; run recover-uploads now and then.
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+
+# Each worker needs a connection per thread, plus a few for its background threads
+# (uploads, thumbnails, mail). Split the database's connection limit between workers
+# and hand the result to create_app through the environment, before the app is loaded.
+db_max_connections = int(os.getenv('DB_MAX_CONNECTIONS', 150))
+per_worker = max(1, db_max_connections // workers)
+pool_size = min(threads + 2, per_worker)
+os.environ.setdefault('DB_POOL_SIZE', str(pool_size))
+os.environ.setdefault('DB_MAX_OVERFLOW', str(max(0, per_worker - pool_size)))
+
+# Every worker has its own pool of thumbnail processes. Half the CPUs between all of them,
+# not half the CPUs each.
+os.environ.setdefault('DERIVATIVE_PROCESSES', str(max(1, multiprocessing.cpu_count() // 2 // workers)))
+
+
+def post_fork(server, worker):
+    # Connections opened by the master before the fork are shared with every worker
+    # through the copied pool. Drop them (without closing the master's sockets) so
+    # each worker opens its own.
+    from flaskalbum import db
+    app = getattr(server.app, 'callable', None)
+    if app is None:
+        return
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
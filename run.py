@@ -1,4 +1,6 @@
-from flaskalbum import app
+from flaskalbum import create_app
+
+app = create_app()
 
 if __name__ == '__main__':
-    app.run(debug=True, port=80, host='0.0.0.0')
\ No newline at end of file
+    app.run(debug=True, port=80, host='0.0.0.0')
@@ -0,0 +1,106 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Table names are read when flaskalbum.models is imported
+os.environ.setdefault('USER_INFO_TABLE', 'user_info')
+os.environ.setdefault('PHOTO_INFO_TABLE', 'photo_info')
+
+import pytest
+from flaskalbum import create_app, db
+from flaskalbum.commands import init_db
+from flaskalbum.models import User
+
+
+@pytest.fixture
+def config(tmp_path):
+    "Settings of the app under test. Override this fixture in a test module to change them."
+    return {
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'app.db'}",
+        'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+        'MEDIA_FOLDER': str(tmp_path / 'media'),
+        'IMAGE_CACHE_DIR': str(tmp_path / 'image-cache'),
+        'STORAGE_BACKEND': 'local',
+        'BCRYPT_LOG_ROUNDS': 4,
+        'BCRYPT_MIN_ROUNDS': 4,
+    }
+
+
+@pytest.fixture
+def app(config):
+    "The app on an empty SQLite database of its own."
+    app = create_app(config)
+    result = app.test_cli_runner().invoke(init_db)
+    assert result.exit_code == 0, result.output
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def user(app):
+    "A registered user, with password 'secret'."
+    assert User.register({'id': 'u1', 'name': 'Ann', 'email': 'ann@example.com', 'username': 'ann', 'password': 'secret'}) == 1
+    return db.session.get(User, 'u1')
+
+
+@pytest.fixture
+def logged_in(client, user):
+    "The test client, signed in as user."
+    response = client.post('/login', data={'login': 1, 'username': 'ann', 'password': 'secret'})
+    assert response.status_code == 302
+    return client
+
+
+class RemoteHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._answer()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._answer()
+
+    def _answer(self):
+        remote = self.server.remote
+        with remote.lock:
+            remote.hits[self.path] = remote.hits.get(self.path, 0) + 1
+        status, content_type, body = remote.routes.get(self.path, (404, 'text/plain', b'not found'))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Remote:
+    "A local HTTP server standing in for the image host and remote images: routes maps a path to the (status, content type, body) it answers, hits counts the requests per path."
+
+    def __init__(self):
+        self.routes = {}
+        self.hits = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RemoteHandler)
+        self.server.remote = self
+        threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def remote():
+    remote = Remote()
+    yield remote
+    remote.close()
@@ -0,0 +1,118 @@
+import threading
+
+import pytest
+from flaskalbum import db
+from flaskalbum.models import AlbumStats, Photo, User
+from flaskalbum.throttle import MemoryStore, SlidingWindowLimiter, login_limiters
+
+
+@pytest.fixture
+def config(config):
+    config.update(LOGIN_LIMIT_PER_ACCOUNT=3, LOGIN_LIMIT_PER_IP=5)
+    return config
+
+
+def login(client, username, password, remote_addr='10.0.0.1'):
+    return client.post(
+        '/login',
+        data={'login': 1, 'username': username, 'password': password},
+        environ_base={'REMOTE_ADDR': remote_addr},
+    )
+
+
+def test_register(client):
+    data = {'name': 'Ann', 'email': 'ann@example.com', 'username': 'ann', 'password': 'secret'}
+    response = client.post('/register', data=data)
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/login')
+
+    user = User.find_for_login('ann')
+    assert user.email == 'ann@example.com'
+    assert user.password != 'secret'
+    assert User.authenticate(user, 'secret') is not None
+
+
+def test_register_duplicates(user):
+    base = {'id': 'u2', 'name': 'Bob', 'password': 'secret'}
+    assert User.register(dict(base, username='ann', email='bob@example.com')) == -1
+    assert User.register(dict(base, username='bob', email='ann@example.com')) == -2
+    assert User.register(dict(base, username='bob', email='bob@example.com')) == 1
+
+
+def test_login(client, user):
+    assert login(client, 'ann', 'wrong').status_code == 200
+    response = login(client, 'ann', 'secret')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/home')
+
+
+def test_account_throttled_across_username_and_email(client, user):
+    for username in ('ann', 'ann@example.com', 'ann'):
+        assert login(client, username, 'wrong').status_code == 200
+
+    # The right password does not get past the limit either
+    response = login(client, 'ann@example.com', 'secret')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) > 0
+    assert b'Too many login attempts' in response.data
+
+
+def test_unknown_account_throttled(client):
+    for _ in range(3):
+        assert login(client, 'nobody', 'wrong').status_code == 200
+    assert login(client, 'Nobody ', 'wrong').status_code == 429
+
+
+def test_successful_login_resets_account_budget(client, user):
+    for _ in range(2):
+        login(client, 'ann', 'wrong')
+    assert login(client, 'ann', 'secret').status_code == 302
+    client.get('/logout')
+
+    for _ in range(3):
+        assert login(client, 'ann', 'wrong', remote_addr='10.0.0.2').status_code == 200
+
+
+def test_client_ip_throttled(client, user):
+    for number in range(5):
+        assert login(client, f'user{number}', 'wrong').status_code == 200
+    assert login(client, 'ann', 'secret').status_code == 429
+    assert login(client, 'ann', 'secret', remote_addr='10.0.0.2').status_code == 302
+
+    account, ip = login_limiters()
+    assert ip.stats() == {'allowed': 6, 'rejected': 1}
+
+
+def test_limiter_counts_concurrent_attempts():
+    limiter = SlidingWindowLimiter('test', limit=10, window=60, store=MemoryStore())
+    results = []
+    start = threading.Barrier(50)
+
+    def attempt():
+        start.wait()
+        results.append(limiter.hit('key'))
+
+    threads = [threading.Thread(target=attempt) for _ in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(True) == 10
+    assert limiter.stats() == {'allowed': 10, 'rejected': 40}
+
+
+def test_delete_account(user):
+    user_id = user.id
+    for number in range(3):
+        photo = Photo(id=f'p{number}', filename=f'{number}.jpg', user_id=user.id, tags='sun')
+        db.session.add(photo)
+        photo.sync_tags()
+    AlbumStats.record(user.id, added=[photo.stats_entry()])
+    db.session.commit()
+
+    assert User.delete_account('ann')
+    db.session.expire_all()
+    assert User.find_for_login('ann') is None
+    assert Photo.query.count() == 0
+    assert db.session.get(AlbumStats, user_id) is None
@@ -0,0 +1,107 @@
+import os
+import threading
+
+import pytest
+from flaskalbum.imageproxy import get_image_cache, proxy_srcset, proxy_url
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 1024
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'
+
+
+@pytest.fixture
+def images(remote):
+    remote.routes['/a.png'] = (200, 'image/png', PNG)
+    remote.routes['/b.png'] = (200, 'image/png', PNG)
+    remote.routes['/a.svg'] = (200, 'image/svg+xml', SVG)
+    remote.routes['/page'] = (200, 'text/html', b'<html></html>')
+    return remote
+
+
+def test_proxy_urls(app):
+    with app.test_request_context():
+        url = proxy_url('https://images.example.com/a.png')
+        assert url.startswith('/img/')
+        assert proxy_url('/media/a.png') == '/media/a.png'
+        assert proxy_url(None) is None
+        srcset = proxy_srcset('https://images.example.com/a.png 320w, https://images.example.com/b.png 640w')
+        assert [candidate.split(' ')[1] for candidate in srcset.split(', ')] == ['320w', '640w']
+
+
+def test_serves_cached_image(app, client, images):
+    with app.test_request_context():
+        url = proxy_url(images.url('/a.png'))
+
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.data == PNG
+    assert response.mimetype == 'image/png'
+    assert response.headers['X-Content-Type-Options'] == 'nosniff'
+    assert response.headers['Content-Security-Policy'] == "default-src 'none'"
+    assert response.cache_control.public and response.cache_control.immutable
+
+    again = client.get(url)
+    assert again.data == PNG
+    assert again.headers['ETag'] == response.headers['ETag']
+    assert again.headers['Last-Modified'] == response.headers['Last-Modified']
+    assert images.hits['/a.png'] == 1
+
+    assert client.get(url, headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+
+def test_hits_do_not_touch_the_image(app, client, images):
+    with app.test_request_context():
+        url = proxy_url(images.url('/a.png'))
+    client.get(url)
+    path, _ = get_image_cache().get(images.url('/a.png'))
+    os.utime(path, (0, 0))
+
+    client.get(url)
+    assert os.stat(path).st_mtime == 0
+
+
+def test_concurrent_misses_fetch_once(app, images):
+    with app.test_request_context():
+        url = proxy_url(images.url('/b.png'))
+    statuses = []
+
+    def get():
+        statuses.append(app.test_client().get(url).status_code)
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses == [200] * 8
+    assert images.hits['/b.png'] == 1
+
+
+@pytest.mark.parametrize('path', ['/a.svg', '/page', '/missing.png'])
+def test_refuses_anything_but_raster_images(app, client, images, path):
+    with app.test_request_context():
+        url = proxy_url(images.url(path))
+    assert client.get(url).status_code == 502
+    assert os.listdir(app.config['IMAGE_CACHE_DIR']) == []
+
+
+def test_refuses_unsigned_urls(app, client, images):
+    with app.test_request_context():
+        url = proxy_url(images.url('/a.png'))
+    assert client.get(url[:-4] + 'abcd').status_code == 404
+    assert images.hits == {}
+
+
+def test_evicts_least_recently_used(app, images):
+    cache = get_image_cache()
+    cache.max_bytes = 2.5 * len(PNG)
+    images.routes['/c.png'] = (200, 'image/png', PNG)
+    a, _ = cache.get(images.url('/a.png'))
+    b, _ = cache.get(images.url('/b.png'))
+    os.utime(a + '.type', (1, 1))
+    os.utime(b + '.type', (2, 2))
+    # A hit makes a the most recently used
+    cache.get(images.url('/a.png'))
+
+    cache.get(images.url('/c.png'))
+    assert os.path.exists(a)
+    assert not os.path.exists(b)
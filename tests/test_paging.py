@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+import pytest
+from flaskalbum import db
+from flaskalbum.models import PHOTOS_PER_PAGE, Photo, User
+
+
+@pytest.fixture
+def photos(user):
+    "Seven photos of user, three of them uploaded at the same instant, and one photo of another user."
+    start = datetime(2024, 5, 1, 12, 0)
+    dates = [start, start, start, start + timedelta(minutes=1), start + timedelta(minutes=2), start + timedelta(minutes=3), start + timedelta(minutes=4)]
+    for number, upload_date in enumerate(dates):
+        photo = Photo(id=f'p{number}', filename=f'{number}.jpg', user_id=user.id, upload_date=upload_date, tags='sea' if number % 2 else 'sun')
+        db.session.add(photo)
+        photo.sync_tags()
+    User.register({'id': 'u2', 'name': 'Bob', 'email': 'bob@example.com', 'username': 'bob', 'password': 'secret'})
+    db.session.add(Photo(id='other', filename='other.jpg', user_id='u2', upload_date=start + timedelta(minutes=2)))
+    db.session.commit()
+    # Newest first, ties broken by id
+    return ['p6', 'p5', 'p4', 'p3', 'p2', 'p1', 'p0']
+
+
+def all_pages(user_id, limit, tags=None):
+    pages = []
+    cursor = None
+    while True:
+        page, cursor = Photo.page_for_user(user_id, cursor=cursor, limit=limit, tags=tags)
+        pages.append([photo.id for photo in page])
+        if cursor is None:
+            return pages
+
+
+def test_pages_cover_every_photo_once(photos, user):
+    assert all_pages(user.id, limit=2) == [['p6', 'p5'], ['p4', 'p3'], ['p2', 'p1'], ['p0']]
+    assert all_pages(user.id, limit=7) == [photos]
+
+
+def test_page_boundary_inside_equal_upload_dates(photos, user):
+    first, cursor = Photo.page_for_user(user.id, limit=5)
+    assert [photo.id for photo in first] == photos[:5]
+    rest, cursor = Photo.page_for_user(user.id, cursor=cursor, limit=5)
+    assert [photo.id for photo in rest] == ['p1', 'p0']
+    assert cursor is None
+
+
+def test_pages_skip_photos_added_before_the_cursor(photos, user):
+    page, cursor = Photo.page_for_user(user.id, limit=3)
+    # A new upload lands on the first page, not in the middle of the next one
+    db.session.add(Photo(id='p7', filename='7.jpg', user_id=user.id))
+    db.session.commit()
+    page, cursor = Photo.page_for_user(user.id, cursor=cursor, limit=3)
+    assert [photo.id for photo in page] == ['p3', 'p2', 'p1']
+
+
+def test_pages_of_tagged_photos(photos, user):
+    assert all_pages(user.id, limit=2, tags=['sea']) == [['p5', 'p3'], ['p1']]
+    assert all_pages(user.id, limit=2, tags=['sea', 'sun']) == [[]]
+    assert all_pages(user.id, limit=2, tags=['unknown']) == [[]]
+
+
+def test_invalid_cursor(user):
+    with pytest.raises(ValueError):
+        Photo.page_for_user(user.id, cursor='not a cursor')
+
+
+def test_api_photos(photos, user, logged_in):
+    # Enough older photos for a second page
+    for number in range(PHOTOS_PER_PAGE):
+        db.session.add(Photo(id=f'old{number:02}', filename=f'old{number}.jpg', user_id=user.id, upload_date=datetime(2024, 1, 1)))
+    db.session.commit()
+    photos = photos + [f'old{number:02}' for number in reversed(range(PHOTOS_PER_PAGE))]
+
+    seen = []
+    pages = 0
+    cursor = None
+    while True:
+        response = logged_in.get('/api/photos', query_string={'cursor': cursor} if cursor else {})
+        assert response.status_code == 200
+        data = response.get_json()
+        seen += [photo['id'] for photo in data['photos']]
+        pages += 1
+        cursor = data['next_cursor']
+        if cursor is None:
+            break
+    assert seen == photos
+    assert pages == 2
+
+    assert logged_in.get('/api/photos', query_string={'tag': 'sun'}).get_json()['photos'][0]['id'] == 'p6'
+    assert logged_in.get('/api/photos', query_string={'cursor': '%%%'}).status_code == 400
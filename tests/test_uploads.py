@@ -0,0 +1,128 @@
+import io
+import json
+import os
+
+import pytest
+from PIL import Image
+from flaskalbum import db
+from flaskalbum.models import AlbumStats, Photo
+from flaskalbum.uploads import get_upload_queue, process_upload, staging_path
+
+
+def jpeg(size=(640, 480)):
+    data = io.BytesIO()
+    Image.new('RGB', size, 'teal').save(data, 'JPEG')
+    return data.getvalue()
+
+
+def pending_photo(user, data, photo_id='p1'):
+    "A pending photo row with its file staged, as the upload route leaves it."
+    photo = Photo(id=photo_id, filename='u1_beach.jpg', title='Beach', user_id=user.id, status=Photo.STATUS_PENDING)
+    db.session.add(photo)
+    db.session.commit()
+    path = staging_path(photo.id, photo.filename)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return photo, path
+
+
+def reload(photo_id):
+    db.session.expire_all()
+    return db.session.get(Photo, photo_id)
+
+
+def test_upload_route_hands_photo_to_worker(app, logged_in):
+    response = logged_in.post('/upload_photo', data={
+        'photo': (io.BytesIO(jpeg()), 'beach.jpg'),
+        'title': 'Beach',
+        'description': '',
+        'location': 'Goa',
+        'tags': 'sun, sea',
+    }, content_type='multipart/form-data')
+    assert response.status_code == 302
+
+    get_upload_queue().join()
+    photo = Photo.query.one()
+    status = logged_in.get(f'/api/photos/{photo.id}/status').get_json()
+    assert status['status'] == Photo.STATUS_READY
+    assert status['url'] == f'/media/{photo.storage_key}'
+    assert AlbumStats.get(photo.user_id).tag_counts == {'sun': 1, 'sea': 1}
+
+
+def test_process_upload(app, user, client):
+    data = jpeg()
+    photo, path = pending_photo(user, data)
+    version = AlbumStats.version_of(user.id)
+
+    process_upload(app, photo.id, path)
+
+    photo = reload(photo.id)
+    assert photo.status == Photo.STATUS_READY
+    assert photo.image_url == f'/media/{photo.storage_key}'
+    assert client.get(photo.image_url).data == data
+    assert photo.thumbnail_url and photo.srcset
+    assert not os.path.exists(path)
+    # Cached gallery pages that showed it pending are stale
+    assert AlbumStats.version_of(user.id) > version
+
+
+def test_process_upload_skips_photo_no_longer_pending(app, user):
+    photo, path = pending_photo(user, jpeg())
+    photo.status = Photo.STATUS_FAILED
+    db.session.commit()
+
+    process_upload(app, photo.id, path)
+
+    assert reload(photo.id).status == Photo.STATUS_FAILED
+    assert not os.path.exists(path)
+
+
+def test_process_upload_without_staged_file(app, user):
+    photo, path = pending_photo(user, jpeg())
+    os.remove(path)
+
+    process_upload(app, photo.id, path)
+
+    photo = reload(photo.id)
+    assert photo.status == Photo.STATUS_FAILED
+    assert photo.image_url is None
+
+
+class TestRemoteStorage:
+    @pytest.fixture
+    def config(self, config, remote):
+        config.update(
+            STORAGE_BACKEND='remote',
+            IMAGE_HOST_URL=remote.url('/upload'),
+            IMAGE_HOST_RETRIES=2,
+            IMAGE_HOST_BACKOFF=0,
+        )
+        return config
+
+    def test_uploaded(self, app, user, remote):
+        body = json.dumps({'status_code': 200, 'image': {'url': 'https://images.example.com/beach.jpg'}}).encode()
+        remote.routes['/upload'] = (200, 'application/json', body)
+        photo, path = pending_photo(user, b'not an image')
+
+        process_upload(app, photo.id, path)
+
+        photo = reload(photo.id)
+        assert photo.status == Photo.STATUS_READY
+        assert photo.image_url == 'https://images.example.com/beach.jpg'
+        # Thumbnails failed, the photo is usable without them
+        assert photo.thumbnail_url is None
+        assert not os.path.exists(path)
+
+    def test_image_host_down(self, app, user, remote):
+        remote.routes['/upload'] = (503, 'application/json', b'{}')
+        photo, path = pending_photo(user, jpeg())
+        version = AlbumStats.version_of(user.id)
+
+        process_upload(app, photo.id, path)
+
+        photo = reload(photo.id)
+        assert photo.status == Photo.STATUS_FAILED
+        assert photo.image_url is None
+        assert remote.hits['/upload'] == 2
+        assert not os.path.exists(path)
+        assert AlbumStats.version_of(user.id) > version
@@ -0,0 +1,4 @@
+# Entry point for production servers: gunicorn -c gunicorn.conf.py wsgi:app
+from flaskalbum import create_app
+
+app = create_app()